@@ -0,0 +1,193 @@
+import json
+import mmap
+from array import array
+
+import numpy as np
+
+
+COLOR_TABLE_SIZE = 1024     # entries in the value-to-color lookup table
+
+ANIMATION_EXTENSION = '.anim'
+ANIMATION_MAGIC = b'ANIMDATA'
+ANIMATION_VERSION = 1
+ANIMATION_ALIGNMENT = mmap.PAGESIZE
+ANIMATION_WINDOW_ROWS = 1024    # samples of a mapped animation held in memory around the clock
+
+
+def color_from_value(value):
+    # non-linear scale from blue (0) to red (1)
+    x = value ** 0.5
+    return (255 * x, 0, 255 * (1 - x))
+
+
+COLOR_TABLE = np.rint([color_from_value(v) for v in np.linspace(0, 1, COLOR_TABLE_SIZE)]).astype(np.uint8)
+
+
+def colors_from_values(values):
+    return COLOR_TABLE[np.rint(np.clip(values, 0, 1) * (COLOR_TABLE_SIZE - 1)).astype(np.intp)]
+
+
+# Value of every column at time, interpolated between the sample rows of values at the sorted times;
+# held at the ends outside them
+def interpolate(times, values, time):
+    i = np.searchsorted(times, time)
+    if i == 0:
+        return values[0]
+    if i == len(times):
+        return values[-1]
+    t1, t2 = times[i - 1], times[i]
+    return values[i - 1] + (values[i] - values[i - 1]) * ((time - t1) / (t2 - t1))
+
+
+def align(offset):
+    return offset + -offset % ANIMATION_ALIGNMENT
+
+
+# Values of a set of bodies over time, stored column-wise: one row of values (one column per
+# animated body) at each sample time. Series sampled at different times are resampled onto the
+# union of their times, which is exact for piecewise-linear data.
+class Animation:
+    def __init__(self, times, values, bodies):
+        self.times = times          # sorted sample times
+        self.values = values        # (len(times), len(bodies)) value of each animated body at each time
+        self.bodies = bodies        # indices of the animated bodies (-1 once removed)
+
+    # series should be of form
+    # [(body_label, [(time, value), ...]), ...]
+    # labels that are not in body_index (label -> body index) are ignored
+    @staticmethod
+    def from_series(series, body_index, time_scale=1):
+        series = [(body_index[label], np.array(points, dtype=float).reshape(-1, 2)) for label, points in series if label in body_index and len(points)]
+        times = np.unique(np.concatenate([points[:, 0] for _, points in series])) * time_scale if series else np.empty(0)
+        values = np.empty((len(times), len(series)), dtype=np.float32)
+        for column, (_, points) in enumerate(series):
+            order = np.argsort(points[:, 0], kind='stable')
+            values[:, column] = np.interp(times, points[order, 0] * time_scale, points[order, 1])
+        bodies = np.array([body for body, _ in series], dtype=np.intp)
+        return Animation(times, values, bodies)
+
+    # Opens a file written by save (or an AnimationWriter) for playback in a System whose bodies are
+    # given by body_index (label -> body index); see MappedAnimation
+    @staticmethod
+    def load(path, body_index, time_scale=1, window_rows=ANIMATION_WINDOW_ROWS):
+        return MappedAnimation(path, body_index, time_scale, window_rows)
+
+    # labels are the body labels of the columns; columns labeled None are left out
+    def save(self, path, labels):
+        columns = [column for column, label in enumerate(labels) if label is not None]
+        with AnimationWriter(path, [labels[column] for column in columns]) as writer:
+            for start in range(0, len(self.times), ANIMATION_WINDOW_ROWS):
+                end = start + ANIMATION_WINDOW_ROWS
+                writer.write_rows(self.times[start:end], self.values[start:end, columns])
+
+    # Linearly interpolated values of every animated body; held at the ends outside the series
+    def values_at(self, time):
+        if len(self.times) == 0:
+            return np.zeros(len(self.bodies), dtype=np.float32)
+        return interpolate(self.times, self.values, time)
+
+    def colors_at(self, time):
+        return colors_from_values(self.values_at(time))
+
+    # Keeps the body indices valid after body index was removed from the System and the last body
+    # (last) was moved into its place; the removed body's column is no longer applied
+    def remove_body(self, index, last):
+        self.bodies[self.bodies == index] = -1
+        self.bodies[self.bodies == last] = index
+
+
+# Writes an animation file a block of sample rows at a time, so the series never has to be in memory.
+# The file holds a JSON header (with the body label of every column), then the values as a
+# (times, columns) float32 matrix and the times as float64, each page aligned so they can be mapped.
+class AnimationWriter:
+    def __init__(self, path, labels):
+        self.labels = [str(label) for label in labels]
+        self.file = open(path, 'wb')
+        self.file.write(ANIMATION_MAGIC)
+        self.header_space = len(json.dumps(self.labels).encode()) + 1024
+        self.values_offset = align(len(ANIMATION_MAGIC) + 8 + self.header_space)
+        self.file.seek(self.values_offset)
+        self.times = array('d')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # times must be increasing, also across calls; values is (len(times), len(labels))
+    def write_rows(self, times, values):
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=np.float32).reshape(len(times), len(self.labels))
+        if np.any(np.diff(np.r_[self.times[-1:], times]) <= 0):
+            raise Exception('Animation times must be increasing')
+        self.times.extend(times.tolist())
+        values.tofile(self.file)
+
+    def close(self):
+        times_offset = align(self.file.tell())
+        self.file.seek(times_offset)
+        np.frombuffer(self.times, dtype=float).tofile(self.file)
+        self.file.truncate(times_offset + len(self.times) * 8)     # extends the file if nothing was written
+        header = json.dumps({
+            'version': ANIMATION_VERSION,
+            'labels': self.labels,
+            'rows': len(self.times),
+            'values_offset': self.values_offset,
+            'times_offset': times_offset
+        }).encode()
+        self.file.seek(len(ANIMATION_MAGIC))
+        self.file.write(len(header).to_bytes(8, 'little'))
+        self.file.write(header)
+        self.file.close()
+
+
+# Animation played back from a memory-mapped animation file. Only a window of sample rows around the
+# last requested time is kept in memory: when the clock leaves it, the next window is copied out of the
+# mapping and the mapped pages are released again, so memory use does not grow with the series length.
+# Columns whose label is not in body_index are not applied (their body is -1).
+class MappedAnimation(Animation):
+    def __init__(self, path, body_index, time_scale=1, window_rows=ANIMATION_WINDOW_ROWS):
+        with open(path, 'rb') as f:
+            if f.read(len(ANIMATION_MAGIC)) != ANIMATION_MAGIC:
+                raise Exception(f'Not an animation file: {path}')
+            header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+            if header['version'] != ANIMATION_VERSION:
+                raise Exception(f'Unsupported animation version: {header["version"]}')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        rows, columns = header['rows'], len(header['labels'])
+        times = np.frombuffer(self.map, dtype=float, count=rows, offset=header['times_offset'])
+        values = np.frombuffer(self.map, dtype=np.float32, count=rows * columns, offset=header['values_offset'])
+        bodies = np.array([body_index.get(label, -1) for label in header['labels']], dtype=np.intp)
+        super().__init__(times * time_scale if time_scale != 1 else times, values.reshape(rows, columns), bodies)
+        self.values_offset = header['values_offset']
+        self.window_rows = max(2, window_rows)
+        self.window_start = 0
+        self.window_times = self.times[:0]
+        self.window_values = self.values[:0]
+
+    # Copies the sample rows [start, start + window_rows) into memory and releases their mapped pages
+    def load_window(self, start):
+        start = max(min(start, len(self.times) - self.window_rows), 0)
+        end = min(start + self.window_rows, len(self.times))
+        self.window_start = start
+        self.window_times = np.array(self.times[start:end])
+        self.window_values = np.array(self.values[start:end])
+        if not hasattr(self.map, 'madvise'):
+            return      # not available on this platform; the OS pages the mapping out under memory pressure
+        row_bytes = self.values.shape[1] * self.values.itemsize
+        first_page = (self.values_offset + start * row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.map.madvise(mmap.MADV_DONTNEED, first_page, self.values_offset + end * row_bytes - first_page)
+
+    def values_at(self, time):
+        if len(self.times) == 0:
+            return np.zeros(len(self.bodies), dtype=np.float32)
+        window_end = self.window_start + len(self.window_times)
+        covered = len(self.window_times) and (
+            (self.window_times[0] <= time or self.window_start == 0) and
+            (time <= self.window_times[-1] or window_end == len(self.times))
+        )
+        if not covered:
+            self.load_window(np.searchsorted(self.times, time) - 1)
+        return interpolate(self.window_times, self.window_values, time)
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+MAX_DEPTH = 16      # levels below the root; cell coordinates must fit in 16 bits
+
+
+def spread_bits(x):
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+
+# Z-order (Morton) code of each position within the square [lo, lo + size)
+def morton_codes(positions, lo, size):
+    cells = ((positions - lo) / size * (1 << MAX_DEPTH)).astype(np.int64)
+    np.clip(cells, 0, (1 << MAX_DEPTH) - 1, out=cells)
+    return spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << 1)
+
+
+# Smallest power-of-two square, aligned to a grid of half its size, that contains every position.
+# Snapping the root keeps cell boundaries fixed while bodies move, which avoids jitter in the forces.
+def aligned_bounds(positions):
+    lo, hi = positions.min(axis=0), positions.max(axis=0)
+    if not (np.isfinite(lo).all() and np.isfinite(hi).all()):
+        raise Exception(f'Non-finite positions: from {lo} to {hi}')
+    size = 2.0 ** np.ceil(np.log2(max((hi - lo).max(), np.finfo(float).tiny)))
+    while np.isfinite(size):
+        aligned_lo = np.floor(lo / (size / 2)) * (size / 2)
+        if (hi < aligned_lo + size).all():
+            return aligned_lo, size
+        size *= 2
+    raise Exception(f'Positions too far apart to bound: from {lo} to {hi}')
+
+
+class QuadTreeLevel:
+    def __init__(self, keys, counts, charges, centers, body_nodes):
+        self.keys = keys                # sorted cell keys of the non-empty nodes
+        self.counts = counts            # number of bodies in each node
+        self.charges = charges          # total charge of each node
+        self.centers = centers          # center of charge of each node
+        self.body_nodes = body_nodes    # node index of every body at this level
+        self.child_starts = None        # range of each node's children in the next level
+        self.child_ends = None
+
+
+# Quadtree stored level by level as flat arrays, so traversal can be done for all bodies at once
+class QuadTree:
+    def __init__(self, positions, charges):
+        lo, self.size = aligned_bounds(positions)
+        codes = morton_codes(positions, lo, self.size)
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        sorted_positions = positions[order]
+        sorted_charges = charges[order]
+        weights = np.where(sorted_charges != 0, sorted_charges, 1)     # fall back to geometric center
+
+        self.levels = []
+        for depth in range(MAX_DEPTH + 1):
+            keys = sorted_codes >> (2 * (MAX_DEPTH - depth))
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            counts = np.diff(np.r_[starts, len(keys)])
+            node_charges = np.add.reduceat(sorted_charges, starts)
+            node_weights = np.add.reduceat(weights, starts)
+            centers = np.add.reduceat(sorted_positions * weights[:, None], starts) / node_weights[:, None]
+            body_nodes = np.empty(len(keys), dtype=np.intp)
+            body_nodes[order] = np.repeat(np.arange(len(starts)), counts)
+            level = QuadTreeLevel(keys[starts], counts, node_charges, centers, body_nodes)
+
+            if self.levels:
+                parent = self.levels[-1]
+                parent_index = np.searchsorted(parent.keys, level.keys >> 2)
+                parent.child_starts = np.searchsorted(parent_index, np.arange(len(parent.keys)), side='left')
+                parent.child_ends = np.searchsorted(parent_index, np.arange(len(parent.keys)), side='right')
+            self.levels.append(level)
+            if counts.max() == 1:
+                break
+
+    def node_size(self, depth):
+        return self.size / (1 << depth)
+
+
+# Approximate repulsion (coefficient not applied) using the Barnes-Hut opening criterion:
+# a node of width s at distance d from a body is treated as a single charge when s / d < theta.
+# Forces are computed on the target bodies (default all) and are zero elsewhere.
+# tree may be passed in when it is reused for several sets of targets over the same positions.
+def barnes_hut_repulsion(positions, charges, theta, targets=None, tree=None):
+    n = len(positions)
+    forces = np.zeros_like(positions)
+    if n < 2:
+        return forces
+
+    tree = QuadTree(positions, charges) if tree is None else tree
+    targets = np.arange(n) if targets is None else np.asarray(targets, dtype=np.intp)
+    all_bodies = len(targets) == n
+    target_forces = np.zeros((len(targets), 2))
+    slots = np.arange(len(targets))     # position of each body in targets
+    bodies = targets
+    nodes = np.zeros(len(bodies), dtype=np.intp)
+    for depth, level in enumerate(tree.levels):
+        last_level = depth == len(tree.levels) - 1
+        contains_self = level.body_nodes[bodies] == nodes
+        disp = positions[bodies] - level.centers[nodes]
+        dist_sq = np.einsum('ij,ij->i', disp, disp)
+        far_enough = tree.node_size(depth) ** 2 < theta ** 2 * dist_sq
+        accept = ~contains_self & ((level.counts[nodes] == 1) | far_enough | last_level)
+        accept &= dist_sq > 0
+
+        magnitude = charges[bodies[accept]] * level.charges[nodes[accept]] / dist_sq[accept]
+        for axis in range(2):
+            target_forces[:, axis] += np.bincount(slots[accept], disp[accept, axis] * magnitude, minlength=len(targets))
+
+        # open every node that contains other bodies and was too close to approximate
+        if last_level:
+            break
+        open_node = contains_self & (level.counts[nodes] > 1)
+        open_node |= ~contains_self & ~accept & (level.counts[nodes] > 1)
+        bodies, nodes, slots = bodies[open_node], nodes[open_node], slots[open_node]
+        if len(bodies) == 0:
+            break
+        starts = level.child_starts[nodes]
+        num_children = level.child_ends[nodes] - starts
+        bodies = np.repeat(bodies, num_children)
+        slots = np.repeat(slots, num_children)
+        offsets = np.arange(len(bodies)) - np.repeat(np.cumsum(num_children) - num_children, num_children)
+        nodes = np.repeat(starts, num_children) + offsets
+
+    # approximated forces are not exactly equal and opposite; remove the net force so the layout does not drift
+    if all_bodies:
+        target_forces -= target_forces.mean(axis=0)
+    forces[targets] = target_forces
+    return forces
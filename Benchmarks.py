@@ -0,0 +1,352 @@
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pygame
+
+from Graphs import Graph
+from Physics import System
+from Placement import PLACEMENTS
+from Layout import DEFAULT_TIMESTEP
+from Parallel import ParallelForces
+from Render import Viewport, render_system
+from UIHelpers import get_sized_font, measure_text
+from Colors import WHITE
+
+
+SEED = 0
+REPEATS = 5
+REGRESSION_THRESHOLD = 0.2      # flag benchmarks whose median time grew by more than this fraction
+BODY_COUNTS = [100, 1000, 10000]
+QUICK_BODY_COUNTS = [100, 1000]
+MAX_EXACT_BODIES = 1000         # exact repulsion is quadratic; larger systems only use Barnes-Hut
+SPRINGS_PER_BODY = 2
+RENDER_DIMS = (1000, 800)       # px
+RENDER_ZOOMS = [1, 10, 100]     # fraction of the layout width shown is 1 / zoom
+QUERIES = 1000                  # get_bodies_at calls per timing
+FONT_LABELS = 200               # distinct labels per get_sized_font timing
+SCALING_BODIES = 20000          # system size for the parallel force scaling benchmark
+PLACEMENT_BODIES = 1000         # system size for the placement benchmark
+PLACEMENT_MAX_STEPS = 2000
+SMALL_GRAPH_SEEDS = 20          # placements of each small graph checked for non-finite positions
+ENERGY_CHECK_INTERVAL = 10      # steps between layout energy evaluations
+ENERGY_BLOCK_SIZE = 1 << 20     # body pairs evaluated at once
+
+
+# Graph with vertices on a jittered grid and springs between nearby grid cells, so that the layout
+# (and therefore the rendering work) looks like a settled real-world layout
+def grid_graph(n, m, rng):
+    side = max(1, int(np.ceil(np.sqrt(n))))
+    sources = rng.integers(0, n, m)
+    offsets = rng.choice([1, side - 1, side, side + 1], m)
+    targets = (sources + offsets) % n
+    weights = rng.uniform(0.5, 5, m)
+    return Graph.from_arrays(range(n), sources, targets, weights)
+
+
+def grid_positions(n, rng):
+    side = max(1, int(np.ceil(np.sqrt(n))))
+    cells = np.column_stack([np.arange(n) % side, np.arange(n) // side])
+    return cells * 1.5 + rng.uniform(-0.3, 0.3, (n, 2))
+
+
+def grid_system(n, rng):
+    system = System.from_graph(grid_graph(n, n * SPRINGS_PER_BODY, rng), positions=grid_positions(n, rng))
+    system.sleep_enabled = False    # keep every step doing the full amount of work
+    return system
+
+
+# Median and minimum wall-clock time of fn over repeats calls, after one untimed warm-up call
+def time_call(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'repeats': repeats}
+
+
+# Each benchmark yields (name, fn) pairs; fn is timed and anything built before it is not
+def step_benchmarks(body_counts, rng):
+    for n in body_counts:
+        system = grid_system(n, rng)
+        modes = ['exact', 'barnes_hut'] if n <= MAX_EXACT_BODIES else ['barnes_hut']
+        for mode in modes:
+            def step(system=system, mode=mode):
+                system.repulsion_mode = mode
+                system.step(0.05)
+            yield f'step/{mode}/n={n}', step
+
+
+def graph_benchmarks(body_counts, rng):
+    for n in body_counts:
+        m = n * SPRINGS_PER_BODY
+        graph = grid_graph(n, m, rng)
+        vertices = [f'v{i}' for i in range(n)]
+        edges = [(vertices[a], vertices[b], w) for a, b, w in zip(graph.sources.tolist(), graph.targets.tolist(), graph.weights.tolist())]
+        positions = grid_positions(n, rng)
+        yield f'graph/from_edges/n={n}', lambda: Graph(vertices, edges)
+        yield f'graph/from_arrays/n={n}', lambda: Graph.from_arrays(range(n), graph.sources, graph.targets, graph.weights)
+        yield f'system/from_graph/n={n}', lambda: System.from_graph(graph, positions=positions)
+
+
+def query_benchmarks(body_counts, rng):
+    for n in body_counts:
+        system = grid_system(n, rng)
+        points = rng.uniform(system.positions.min(axis=0), system.positions.max(axis=0), (QUERIES, 2))
+        yield f'get_bodies_at/n={n}/x{QUERIES}', lambda: [system.get_bodies_at(p) for p in points]
+
+
+def render_benchmarks(body_counts, rng):
+    img = pygame.Surface(RENDER_DIMS)
+    for n in body_counts:
+        system = grid_system(n, rng)
+        lo, hi = system.positions.min(axis=0), system.positions.max(axis=0)
+        for zoom in RENDER_ZOOMS:
+            width = (hi - lo)[0] / zoom
+            dims = (width, width * RENDER_DIMS[1] / RENDER_DIMS[0])
+            viewport = Viewport(tuple((lo + hi) / 2 - np.array(dims) / 2), dims)
+
+            def render(system=system, viewport=viewport):
+                img.fill(WHITE)
+                render_system(system, viewport, img)
+            yield f'render_system/n={n}/zoom={zoom}', render
+
+
+def font_benchmarks(body_counts, rng):
+    labels = [''.join(chr(c) for c in rng.integers(97, 123, rng.integers(3, 12))) for _ in range(FONT_LABELS)]
+    widths = rng.integers(16, 200, FONT_LABELS).tolist()
+
+    def cold():
+        get_sized_font.cache_clear()
+        measure_text.cache_clear()
+        for label, width in zip(labels, widths):
+            get_sized_font('Arial', label, width)
+
+    def warm():
+        for label, width in zip(labels, widths):
+            get_sized_font('Arial', label, width)
+    yield f'get_sized_font/cold/x{FONT_LABELS}', cold
+    yield f'get_sized_font/warm/x{FONT_LABELS}', warm
+
+
+BENCHMARKS = [step_benchmarks, graph_benchmarks, query_benchmarks, render_benchmarks, font_benchmarks]
+
+
+def git_revision():
+    try:
+        root = os.path.dirname(os.path.realpath(__file__))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_metadata():
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pygame.version.ver,
+    }
+
+
+def run_benchmarks(body_counts, repeats, only=None):
+    random.seed(SEED)
+    rng = np.random.default_rng(SEED)
+    results = {}
+    for benchmark in BENCHMARKS:
+        for name, fn in benchmark(body_counts, rng):
+            if only and only not in name:
+                continue
+            results[name] = time_call(fn, repeats)
+            print(f'{name:45s} {results[name]["median"] * 1000:10.3f} ms')
+    return {'metadata': machine_metadata(), 'results': results}
+
+
+def process_counts(max_processes):
+    counts = [1 << i for i in range(max_processes.bit_length()) if 1 << i <= max_processes]
+    return counts if counts[-1] == max_processes else counts + [max_processes]
+
+
+# Time per step with the forces computed serially and by ParallelForces with 1, 2, 4, ... processes
+def run_scaling(n, mode, max_processes, repeats):
+    rng = np.random.default_rng(SEED)
+    system = grid_system(n, rng)
+    system.repulsion_mode = mode
+    step = lambda: system.step(0.05)
+    results = {'serial': time_call(step, repeats)}
+    print(f'{"serial":>12s} {results["serial"]["median"] * 1000:10.3f} ms')
+    for processes in process_counts(max_processes):
+        with ParallelForces(system, processes):
+            results[f'processes={processes}'] = result = time_call(step, repeats)
+        speedup = results['serial']['median'] / result['median']
+        print(f'{processes:12d} {result["median"] * 1000:10.3f} ms {speedup:6.2f}x')
+    return {'metadata': machine_metadata(), 'bodies': n, 'repulsion_mode': mode, 'results': results}
+
+
+# Potential energy of the layout: spring energy plus the potential -q_i q_j ln(d) of the exact repulsion
+def layout_energy(system):
+    positions, charges = system.positions, system.charges
+    a, b = system.spring_endpoints.T
+    stretch = np.hypot(*(positions[b] - positions[a]).T) - system.spring_lengths
+    energy = 0.5 * (system.spring_ks * stretch ** 2).sum()
+    n = len(positions)
+    block_rows = max(1, ENERGY_BLOCK_SIZE // max(n, 1))
+    for start in range(0, n, block_rows):
+        rows = np.arange(start, min(n, start + block_rows))
+        dist = np.hypot(*(positions[rows, None, :] - positions[None, :, :]).transpose(2, 0, 1))
+        pairs = np.arange(n)[None, :] > rows[:, None]       # each pair once
+        with np.errstate(divide='ignore'):
+            potential = -charges[rows, None] * charges[None, :] * np.log(dist)
+        energy += system.repulsion_coefficient * potential[pairs & (dist > 0)].sum()
+    return float(energy)
+
+
+# Layout energy every ENERGY_CHECK_INTERVAL steps, until max_steps or until it is at most target
+def energy_trace(system, max_steps, target=-np.inf):
+    system.adaptive_timestep = True
+    energies = [layout_energy(system)]
+    while energies[-1] > target and len(energies) <= max_steps // ENERGY_CHECK_INTERVAL:
+        for _ in range(ENERGY_CHECK_INTERVAL):
+            system.step(DEFAULT_TIMESTEP)
+        energies.append(layout_energy(system))
+    return energies
+
+
+# Time taken by each placement, and the physics steps needed afterwards to reach the energy (default:
+# the energy the random placement reaches after max_steps)
+def run_placements(n, max_steps, energy=None):
+    rng = np.random.default_rng(SEED)
+    np.random.seed(SEED)
+    graph = grid_graph(n, n * SPRINGS_PER_BODY, rng)
+    results = {}
+    for name in sorted(PLACEMENTS, key=lambda name: name != 'random'):
+        start = time.perf_counter()
+        system = System.from_graph(graph, placement=name)
+        placement_time = time.perf_counter() - start
+        energies = energy_trace(system, max_steps, -np.inf if energy is None else energy)
+        if energy is None:
+            energy = energies[-1]
+            print(f'target energy {energy:.6g}')
+        reached = [i for i, e in enumerate(energies) if e <= energy]
+        steps = reached[0] * ENERGY_CHECK_INTERVAL if reached else None
+        results[name] = {'placement_time': placement_time, 'steps': steps}
+        print(f'{name:12s} {placement_time * 1000:10.1f} ms {"not reached" if steps is None else f"{steps:6d} steps"}')
+
+    random_steps = results['random']['steps']
+    for result in results.values():
+        if result['steps'] is not None and random_steps is not None:
+            result['steps_saved'] = random_steps - result['steps']
+    return {'metadata': machine_metadata(), 'bodies': n, 'max_steps': max_steps, 'energy': energy, 'results': results}
+
+
+# Tiny graphs whose layouts are easy to get degenerate: paths, stars and disconnected pieces
+def small_graphs():
+    return {
+        'path of 3': Graph([1, 2, 3], [(1, 2, 1), (2, 3, 1)]),
+        'star of 3': Graph([1, 2, 3], [(1, 2, 1), (1, 3, 1)]),
+        'edge and vertex': Graph([1, 2, 3], [(1, 2, 1)]),
+        'two edges': Graph([1, 2, 3, 4], [(1, 2, 1), (3, 4, 1)]),
+        'three vertices': Graph([1, 2, 3], [])
+    }
+
+
+# Names of the placements that give non-finite positions for any small graph, with the graph
+def check_small_placements():
+    failures = []
+    for graph_name, graph in small_graphs().items():
+        for name in PLACEMENTS:
+            bad_seeds = 0
+            for seed in range(SMALL_GRAPH_SEEDS):
+                np.random.seed(seed)
+                bad_seeds += not np.isfinite(System.from_graph(graph, placement=name).positions).all()
+            if bad_seeds:
+                failures.append(f'{name} on {graph_name}')
+                print(f'{name:12s} {graph_name}: non-finite positions for {bad_seeds} of {SMALL_GRAPH_SEEDS} seeds')
+    return failures
+
+
+# Prints every benchmark present in both runs and returns the names of those that regressed
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before, after = baseline['results'][name]['median'], result['median']
+        ratio = after / before if before > 0 else float('inf')
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:45s} {before * 1000:10.3f} ms {after * 1000:10.3f} ms {ratio:6.2f}x{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the physics, graph, query, rendering and font hot paths.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run.add_argument('output', help='JSON file to write results to')
+    run.add_argument('--quick', action='store_true', help=f'only use {QUICK_BODY_COUNTS} bodies')
+    run.add_argument('--repeats', type=int, default=REPEATS)
+    run.add_argument('--only', default=None, help='only run benchmarks whose name contains this')
+    compare = commands.add_parser('compare', help='flag regressions of one results file against another')
+    compare.add_argument('baseline', help='JSON results to compare against')
+    compare.add_argument('results', help='JSON results to check')
+    compare.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='allowed fractional slowdown')
+    scaling = commands.add_parser('scaling', help='time parallel force computation against the number of processes')
+    scaling.add_argument('--output', default=None, help='JSON file to write results to')
+    scaling.add_argument('--bodies', type=int, default=SCALING_BODIES)
+    scaling.add_argument('--mode', choices=['exact', 'barnes_hut'], default='barnes_hut', help='repulsion mode')
+    scaling.add_argument('--processes', type=int, default=os.cpu_count(), help='largest number of processes')
+    scaling.add_argument('--repeats', type=int, default=REPEATS)
+    placement = commands.add_parser('placement', help='count the physics steps each initial placement needs to reach an energy')
+    placement.add_argument('--output', default=None, help='JSON file to write results to')
+    placement.add_argument('--bodies', type=int, default=PLACEMENT_BODIES)
+    placement.add_argument('--max-steps', type=int, default=PLACEMENT_MAX_STEPS)
+    placement.add_argument('--energy', type=float, default=None, help='target layout energy (default: reached by random placement after max steps)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        pygame.display.init()
+        results = run_benchmarks(QUICK_BODY_COUNTS if args.quick else BODY_COUNTS, args.repeats, args.only)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif args.command in ['scaling', 'placement']:
+        if args.command == 'scaling':
+            results = run_scaling(args.bodies, args.mode, args.processes, args.repeats)
+        else:
+            failures = check_small_placements()
+            results = run_placements(args.bodies, args.max_steps, args.energy)
+            results['small_graph_failures'] = failures
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.command == 'placement' and failures:
+            print(f'{len(failures)} placements gave non-finite positions')
+            sys.exit(1)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, args.threshold)
+        print(f'{len(regressions)} regressions' if regressions else 'no regressions')
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
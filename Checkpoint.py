@@ -0,0 +1,108 @@
+import numpy as np
+
+
+CHECKPOINT_VERSION = 1
+NEIGHBOR_JITTER = 0.1       # meters; spreads out bodies placed at the same neighbour centroid
+
+# System attributes saved alongside the body state
+PARAMETERS = [
+    'repulsion_coefficient',
+    'friction_coefficient',
+    'repulsion_mode',
+    'barnes_hut_theta',
+    'adaptive_timestep',
+    'timestep_scale',
+]
+
+
+# Body state and simulation parameters of a System, keyed by body label so it can be loaded into
+# a System built from a different (e.g. slightly changed) graph
+class Checkpoint:
+    def __init__(self, labels, positions, velocities, locked, parameters):
+        self.labels = labels            # label of each saved body
+        self.positions = positions
+        self.velocities = velocities
+        self.locked = locked
+        self.parameters = parameters    # attribute name -> value
+
+    @staticmethod
+    def from_system(system):
+        return Checkpoint(
+            [str(b.label) for b in system.bodies],
+            system.positions.copy(),
+            system.velocities.copy(),
+            system.locked.copy(),
+            {name: getattr(system, name) for name in PARAMETERS}
+        )
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            if int(data['version']) > CHECKPOINT_VERSION:
+                raise Exception(f'Unsupported checkpoint version: {int(data["version"])}')
+            parameters = {name: data[name].item() for name in PARAMETERS if name in data}
+            return Checkpoint(data['labels'].tolist(), data['positions'], data['velocities'], data['locked'], parameters)
+
+    # path should end in .npz (numpy appends it otherwise)
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            version=CHECKPOINT_VERSION,
+            labels=np.array(self.labels, dtype=str),
+            positions=self.positions,
+            velocities=self.velocities,
+            locked=self.locked,
+            **self.parameters
+        )
+
+    # Restores the saved state of every body of system with a saved label, places the others near
+    # their neighbours, and restores the parameters. Returns the number of bodies matched.
+    def apply(self, system):
+        saved_index = {label: i for i, label in enumerate(self.labels)}
+        matches = [(b.index, saved_index.get(str(b.label), -1)) for b in system.bodies]
+        body_ids = np.array([i for i, _ in matches], dtype=np.intp)
+        saved_ids = np.array([j for _, j in matches], dtype=np.intp)
+        matched = saved_ids >= 0
+
+        system.positions[body_ids[matched]] = self.positions[saved_ids[matched]]
+        system.velocities[body_ids[matched]] = self.velocities[saved_ids[matched]]
+        system.locked[body_ids[matched]] = self.locked[saved_ids[matched]]
+        placed = np.zeros(len(system.bodies), dtype=bool)
+        placed[body_ids[matched]] = True
+        place_near_neighbors(system, placed)
+
+        for name, value in self.parameters.items():
+            setattr(system, name, value)
+        system.grid.update(system.positions)
+        system.still_steps[:] = 0
+        system.wake()
+        return int(matched.sum())
+
+
+# Moves every unplaced body to the centroid of its placed neighbours (plus jitter), repeating outwards
+# until no more can be reached; bodies with no placed body in their component are scattered over the
+# placed bodies' bounding box
+def place_near_neighbors(system, placed):
+    n = len(system.bodies)
+    if placed.all() or not placed.any():
+        return
+    a, b = system.spring_endpoints.T
+    sources, targets = np.r_[a, b], np.r_[b, a]     # both directions of every spring
+    rng = np.random.default_rng()
+    placed = placed.copy()
+    while True:
+        reaching = placed[sources] & ~placed[targets]
+        if not reaching.any():
+            break
+        totals = np.zeros((n, 2))
+        np.add.at(totals, targets[reaching], system.positions[sources[reaching]])
+        counts = np.bincount(targets[reaching], minlength=n)
+        newly_placed = np.flatnonzero(counts)
+        system.positions[newly_placed] = totals[newly_placed] / counts[newly_placed, None] + rng.normal(0, NEIGHBOR_JITTER, (len(newly_placed), 2))
+        system.velocities[newly_placed] = 0
+        placed[newly_placed] = True
+
+    unreached = np.flatnonzero(~placed)
+    lo, hi = system.positions[placed].min(axis=0), system.positions[placed].max(axis=0)
+    system.positions[unreached] = rng.uniform(lo, hi, (len(unreached), 2))
+    system.velocities[unreached] = 0
@@ -0,0 +1,122 @@
+import os
+import shutil
+import subprocess
+from multiprocessing import Pool
+
+import numpy as np
+import pygame
+
+from Physics import SystemView
+from Render import Viewport, render_system
+from Simulation import PHYSICS_TIMESTEP, ANIMATION_SPEED
+from Colors import WHITE
+
+
+EXPORT_RESOLUTION = (1920, 1080)    # px
+EXPORT_FPS = 30
+EXPORT_DURATION = 10                # seconds of video when the system has no animation to follow
+PHYSICS_STEPS_PER_FRAME = 4
+VIEWPORT_MARGIN = 0.05              # fraction of the layout size left empty around it
+FRAME_FILENAME = 'frame_{:05d}.png'
+ENCODER = 'ffmpeg'
+
+
+# Body positions and colors at one output frame
+class Frame:
+    def __init__(self, index, positions, colors):
+        self.index = index
+        self.positions = positions
+        self.colors = colors
+
+
+# Steps the system (and its animation, if any) headlessly and snapshots it at every output frame.
+# Each frame advances the animation clock by ANIMATION_SPEED / fps, as in the live view.
+def simulate_frames(system, num_frames, fps=EXPORT_FPS, timestep=PHYSICS_TIMESTEP, steps_per_frame=PHYSICS_STEPS_PER_FRAME):
+    if system.animation_data is not None:
+        system.animation_clock = 0
+        system.animation_playing = True
+    frames = []
+    for index in range(num_frames):
+        frames.append(Frame(index, system.positions.copy(), system.colors.copy()))
+        for _ in range(steps_per_frame):
+            system.step(timestep, animation_timestep=ANIMATION_SPEED / fps / steps_per_frame)
+    return frames
+
+
+# One viewport, matching the aspect ratio of the resolution, that contains every body in every frame
+def fit_viewport(frames, radii, resolution):
+    radii = radii[:, None]
+    lo = np.min([(frame.positions - radii).min(axis=0, initial=np.inf) for frame in frames], axis=0)
+    hi = np.max([(frame.positions + radii).max(axis=0, initial=-np.inf) for frame in frames], axis=0)
+    if not np.isfinite(lo).all():
+        lo, hi = np.zeros(2), np.ones(2)
+    center = (lo + hi) / 2
+    size = np.maximum(hi - lo, 1e-9) * (1 + 2 * VIEWPORT_MARGIN)
+    aspect = resolution[0] / resolution[1]
+    size = np.array([max(size[0], size[1] * aspect), max(size[1], size[0] / aspect)])
+    return Viewport(tuple(center - size / 2), tuple(size))
+
+
+# Starts the encoder reading raw RGB frames from its stdin, or returns None if it is not installed
+def open_encoder(video_path, resolution, fps):
+    if shutil.which(ENCODER) is None:
+        print(f'{ENCODER} not found; only writing frames')
+        return None
+    command = [
+        ENCODER, '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{resolution[0]}x{resolution[1]}', '-r', str(fps), '-i', '-',
+        '-pix_fmt', 'yuv420p', video_path
+    ]
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+
+# State of each rendering process, set once by init_worker so the system is only sent once per process.
+# It is sent as a SystemView, which (unlike a System) pickles under every start method.
+worker_state = {}
+
+
+def init_worker(system, topleft, dims, resolution, output_dir, return_pixels):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    worker_state.update(
+        system=system,
+        viewport=Viewport(topleft, dims),
+        resolution=resolution,
+        output_dir=output_dir,
+        return_pixels=return_pixels
+    )
+
+
+def render_frame(frame):
+    system = worker_state['system']
+    system.colors = frame.colors
+    img = pygame.Surface(worker_state['resolution'])
+    img.fill(WHITE)
+    render_system(system, worker_state['viewport'], img, frame.positions)
+    pygame.image.save(img, os.path.join(worker_state['output_dir'], FRAME_FILENAME.format(frame.index)))
+    return pygame.image.tobytes(img, 'RGB') if worker_state['return_pixels'] else None
+
+
+# Renders the system to numbered PNGs in output_dir, and to video_path if the encoder is installed.
+# duration is in seconds of video and defaults to the length of the system's animation.
+def export_system(system, output_dir, duration=None, resolution=EXPORT_RESOLUTION, fps=EXPORT_FPS, viewport=None, processes=None, video_path=None):
+    if duration is None:
+        animation = system.animation_data
+        has_animation = animation is not None and len(animation.times)
+        duration = animation.times[-1] / ANIMATION_SPEED if has_animation else EXPORT_DURATION
+    num_frames = max(1, round(duration * fps))
+
+    frames = simulate_frames(system, num_frames, fps)
+    if viewport is None:
+        viewport = fit_viewport(frames, system.radii, resolution)
+
+    os.makedirs(output_dir, exist_ok=True)
+    encoder = open_encoder(video_path, resolution, fps) if video_path else None
+    initargs = (SystemView(system), tuple(viewport.topleft), viewport.dims, resolution, output_dir, encoder is not None)
+    with Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+        for pixels in pool.imap(render_frame, frames):       # in frame order
+            if encoder:
+                encoder.stdin.write(pixels)
+    if encoder:
+        encoder.stdin.close()
+        encoder.wait()
+    return num_frames
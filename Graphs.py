@@ -1,5 +1,95 @@
-from itertools import combinations as combs
+import json
+import os
+import numpy as np
+from array import array
+from itertools import combinations as combs, repeat
 
+
+EDGE_LIST_CHUNK_BYTES = 1 << 22     # approximate amount of text parsed at once
+DELIMITERS = {'.csv': ',', '.tsv': '\t'}
+
+BINARY_EXTENSION = '.graph'
+BINARY_MAGIC = b'GRAPHBIN'
+BINARY_VERSION = 1
+BINARY_ALIGNMENT = 64
+BINARY_ARRAYS = [
+    'sources', 'targets', 'weights', 'vertex_weight_array', 'indptr', 'indices', 'adjacency_edges', 'adjacency_weights'
+]
+
+
+# Yields the rows of a delimited text file a chunk at a time, as 2D string arrays with num_columns
+# columns (missing trailing fields are filled with default, extra ones are an error)
+def read_tables(path, delimiter, header, num_columns, default):
+    if delimiter is None:
+        delimiter = DELIMITERS.get(os.path.splitext(path)[1].lower())
+    with open(path) as f:
+        if header:
+            f.readline()
+        while True:
+            lines = f.readlines(EDGE_LIST_CHUNK_BYTES)
+            if not lines:
+                return
+            rows = [line.strip() for line in lines]
+            rows = [row for row in rows if row and not row.startswith('#')]
+            if not rows:
+                continue
+            text = (delimiter or ' ').join(rows)
+            fields = text.split(delimiter)
+            # every row has num_columns - 1 separators, and (when splitting on whitespace) none of them
+            # are runs, if and only if every row has exactly num_columns fields
+            separators = list(map(str.count, rows, repeat(delimiter or ' ')))
+            if delimiter is None and '\t' in text:
+                separators = [count + row.count('\t') for count, row in zip(separators, rows)]
+            if len(fields) == len(rows) * num_columns and separators.count(num_columns - 1) == len(rows):
+                table = np.array(fields).reshape(len(rows), num_columns)
+            else:   # ragged rows
+                split_rows = [row.split(delimiter) for row in rows]
+                for row, row_fields in zip(rows, split_rows):
+                    if len(row_fields) > num_columns:
+                        raise Exception(f'More than {num_columns} fields present in row: {row}')
+                table = np.array([(row_fields + [default] * num_columns)[:num_columns] for row_fields in split_rows])
+            if delimiter is not None:
+                table = np.char.strip(table)
+            yield table
+
+
+# Interns the labels of a string array, returning an id array of the same shape
+def intern_labels(labels, index):
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    ids = np.array([index.setdefault(label, len(index)) for label in unique_labels.tolist()], dtype=np.int64)
+    return ids[inverse].reshape(labels.shape)
+
+
+def append_array(buffer, values):
+    buffer.frombytes(np.ascontiguousarray(values, dtype=buffer.typecode).tobytes())
+
+
+# Read-only sequence of the vertex labels stored in a binary graph file, decoded on access
+class MappedLabels:
+    def __init__(self, offsets, data, integer):
+        self.offsets = offsets
+        self.data = data
+        self.integer = integer
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        label = bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+        return int(label) if self.integer else label
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+# Vertex labels are interned to integer ids (their position in vertices); edges are kept as
+# id arrays and the undirected adjacency in compressed sparse row (CSR) form
 class Graph:
     @staticmethod
     def complete_graph(n):
@@ -7,17 +97,253 @@ class Graph:
         edges = [(a, b, 1) for a, b in combs(vertices, 2)]
         return Graph(vertices, edges)
 
+    # Streams an edge list in chunks. Each non-empty line holds "source target [weight]" (weight defaults
+    # to 1) and lines starting with # are ignored. The delimiter defaults to ',' for .csv files, tab for
+    # .tsv files and any whitespace otherwise. The optional vertex weight file holds "vertex weight" lines.
+    @staticmethod
+    def from_edge_list(path, delimiter=None, vertex_weights_path=None, header=False):
+        index = {}
+        sources, targets, weights = array('q'), array('q'), array('d')
+        for table in read_tables(path, delimiter, header, 3, '1'):
+            ids = intern_labels(table[:, :2], index)
+            append_array(sources, ids[:, 0])
+            append_array(targets, ids[:, 1])
+            append_array(weights, table[:, 2].astype(float))
+
+        vertex_weights = None
+        if vertex_weights_path:
+            weight_ids, vertex_weight_values = array('q'), array('d')
+            for table in read_tables(vertex_weights_path, delimiter, header, 2, ''):
+                append_array(weight_ids, intern_labels(table[:, 0], index))
+                append_array(vertex_weight_values, table[:, 1].astype(float))
+            vertex_weights = np.full(len(index), np.nan)
+            vertex_weights[np.frombuffer(weight_ids, dtype=np.int64)] = np.frombuffer(vertex_weight_values)
+            if np.isnan(vertex_weights).any():
+                missing = np.flatnonzero(np.isnan(vertex_weights))[0]
+                raise Exception(f'Vertex missing from vertex weights: {list(index)[missing]}')
+
+        return Graph.from_arrays(
+            list(index), np.frombuffer(sources, dtype=np.int64), np.frombuffer(targets, dtype=np.int64),
+            np.frombuffer(weights), vertex_weights
+        )
+
+    # Loads a file written by save_binary. With mmap, arrays and labels are paged in from disk on
+    # access, so loading takes near-constant time regardless of graph size.
+    @staticmethod
+    def load_binary(path, mmap=True):
+        with open(path, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise Exception(f'Not a binary graph file: {path}')
+            header_length = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_length))
+        if header['version'] != BINARY_VERSION:
+            raise Exception(f'Unsupported binary graph version: {header["version"]}')
+
+        def load(name):
+            dtype, shape, offset = header['arrays'][name]
+            if 0 in shape:
+                return np.empty(shape, dtype=dtype)     # nothing to map
+            if mmap:
+                return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+        graph = Graph.__new__(Graph)
+        graph.vertices = MappedLabels(load('label_offsets'), load('label_data'), header['integer_labels'])
+        if not mmap:
+            graph.vertices = list(graph.vertices)
+        graph.vertex_index = None
+        for name in BINARY_ARRAYS:
+            setattr(graph, name, load(name) if name in header['arrays'] else None)
+        graph.weighted_vertices = graph.vertex_weight_array is not None
+        return graph
+
+    # Builds a graph directly from vertex ids; vertex_weights (if given) is aligned with vertices
+    @staticmethod
+    def from_arrays(vertices, sources, targets, weights, vertex_weights=None):
+        graph = Graph.__new__(Graph)
+        graph.vertices = list(vertices)
+        graph.vertex_index = None
+        graph.sources = np.asarray(sources, dtype=np.intp)
+        graph.targets = np.asarray(targets, dtype=np.intp)
+        graph.weights = np.asarray(weights, dtype=float)
+        n = len(graph.vertices)
+        out_of_range = (graph.sources < 0) | (graph.sources >= n) | (graph.targets < 0) | (graph.targets >= n)
+        if out_of_range.any():
+            i = np.flatnonzero(out_of_range)[0]
+            raise Exception(f'Nonexistent vertex present in edge list: {max(graph.sources[i], graph.targets[i])}')
+        graph.set_vertex_weights(vertex_weights)
+        graph.build_adjacency()
+        return graph
+
     def __init__(self, vertices, edges, vertex_weights=None):
-        for e in edges:
-            for v in e[:2]:
-                if v not in vertices:
-                    raise Exception(f'Nonexistent vertex present in edge list: {v}')
-        
-        self.vertices = vertices
-        self.edges = edges
+        self.vertices = list(vertices)
+        self.vertex_index = None
+        if len(self.index) != len(self.vertices):
+            raise Exception('Duplicate vertex present in vertex list')
+
+        index = self.index
+        try:
+            self.sources = np.array([index[e[0]] for e in edges], dtype=np.intp)
+            self.targets = np.array([index[e[1]] for e in edges], dtype=np.intp)
+        except KeyError as e:
+            raise Exception(f'Nonexistent vertex present in edge list: {e.args[0]}')
+        self.weights = np.array([e[2] for e in edges], dtype=float)
 
         if vertex_weights:
-            self.weighted_vertices = True
-            self.vertex_weights = vertex_weights
+            weights = np.empty(len(self.vertices), dtype=float)
+            weighted = np.zeros(len(self.vertices), dtype=bool)
+            for v, w in vertex_weights:
+                if v not in self.index:
+                    raise Exception(f'Nonexistent vertex present in vertex weights: {v}')
+                weights[self.index[v]] = w
+                weighted[self.index[v]] = True
+            if not weighted.all():
+                raise Exception(f'Vertex missing from vertex weights: {self.vertices[np.flatnonzero(~weighted)[0]]}')
+            self.set_vertex_weights(weights)
         else:
-            self.weighted_vertices = False
+            self.set_vertex_weights(None)
+        self.build_adjacency()
+
+    # Map from vertex label to id, built on first use
+    @property
+    def index(self):
+        if self.vertex_index is None:
+            self.vertex_index = {v: i for i, v in enumerate(self.vertices)}
+        return self.vertex_index
+
+    def set_vertex_weights(self, vertex_weights):
+        self.weighted_vertices = vertex_weights is not None and len(vertex_weights) > 0
+        self.vertex_weight_array = np.asarray(vertex_weights, dtype=float) if self.weighted_vertices else None
+
+    # CSR adjacency: the neighbours of vertex i are indices[indptr[i]:indptr[i + 1]], reached through
+    # the edges adjacency_edges[...] with weights adjacency_weights[...]
+    def build_adjacency(self):
+        n = len(self.vertices)
+        edge_ids = np.arange(len(self.sources))
+        loops = self.sources == self.targets
+        rows = np.concatenate([self.sources, self.targets[~loops]])
+        columns = np.concatenate([self.targets, self.sources[~loops]])
+        edges = np.concatenate([edge_ids, edge_ids[~loops]])
+        order = np.argsort(rows, kind='stable')
+        self.indptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=n), out=self.indptr[1:])
+        self.indices = columns[order]
+        self.adjacency_edges = edges[order]
+        self.adjacency_weights = self.weights[self.adjacency_edges]
+
+    def save_binary(self, path):
+        integer_labels = all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in self.vertices)
+        encoded = [str(v).encode('utf-8') for v in self.vertices]
+        label_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=label_offsets[1:])
+        arrays = {name: getattr(self, name) for name in BINARY_ARRAYS if getattr(self, name) is not None}
+        arrays['label_offsets'] = label_offsets
+        arrays['label_data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        # offsets depend on the header length, so lay the arrays out after a generously sized header
+        header_space = 1024 + 128 * len(arrays)
+        offset = len(BINARY_MAGIC) + 8 + header_space
+        layout = {}
+        for name, values in arrays.items():
+            offset += -offset % BINARY_ALIGNMENT
+            values = np.ascontiguousarray(values)
+            layout[name] = (values.dtype.str, list(values.shape), offset)
+            offset += values.nbytes
+        header = json.dumps({'version': BINARY_VERSION, 'integer_labels': integer_labels, 'arrays': layout}).encode()
+        if len(header) > header_space:
+            raise Exception('Binary graph header too large')
+
+        with open(path, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for name, values in arrays.items():
+                f.seek(layout[name][2])
+                np.ascontiguousarray(values).tofile(f)
+            f.truncate(offset)      # also covers the offsets of trailing empty arrays
+
+    @property
+    def edges(self):
+        return [(self.vertices[a], self.vertices[b], w) for a, b, w in zip(self.sources.tolist(), self.targets.tolist(), self.weights.tolist())]
+
+    @property
+    def vertex_weights(self):
+        if not self.weighted_vertices:
+            return None
+        return list(zip(self.vertices, self.vertex_weight_array.tolist()))
+
+    @property
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    def degree(self, v):
+        i = self.index[v]
+        return self.indptr[i + 1] - self.indptr[i]
+
+    def neighbor_ids(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def neighbors(self, v):
+        return [self.vertices[i] for i in self.neighbor_ids(self.index[v])]
+
+    # Number of edges on a shortest path from vertex id source to every vertex (-1 where unreachable),
+    # expanding one whole BFS frontier at a time
+    def bfs_distances(self, source):
+        distances = np.full(len(self.vertices), -1, dtype=np.int32)
+        distances[source] = 0
+        frontier = np.array([source], dtype=np.intp)
+        depth = 0
+        while len(frontier):
+            depth += 1
+            starts = self.indptr[frontier]
+            counts = self.indptr[frontier + 1] - starts
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            reached = self.indices[np.repeat(starts, counts) + offsets]
+            frontier = np.unique(reached[distances[reached] < 0])
+            distances[frontier] = depth
+        return distances
+
+    # Collapses a matching of edges (heaviest first) into single vertices.
+    # Returns the coarser graph and the id of the coarse vertex containing each vertex.
+    def coarsen(self, rounds=3):
+        n = len(self.vertices)
+        match = np.arange(n)
+        matched = np.zeros(n, dtype=bool)
+        # break weight ties randomly, but identically for both directions of an edge
+        noise = np.random.random(len(self.sources))[self.adjacency_edges] * 1e-9
+        rows = np.repeat(np.arange(n), self.degrees)
+        for _ in range(rounds):
+            # every unmatched vertex proposes to its heaviest unmatched neighbour; mutual proposals are matched
+            candidates = ~matched[rows] & ~matched[self.indices] & (rows != self.indices)
+            if not candidates.any():
+                break
+            r, c = rows[candidates], self.indices[candidates]
+            order = np.lexsort((self.adjacency_weights[candidates] + noise[candidates], r))
+            last = np.r_[r[order][1:] != r[order][:-1], True]
+            proposal = np.full(n, -1)
+            proposal[r[order][last]] = c[order][last]
+            proposers = np.flatnonzero(proposal >= 0)
+            mutual = proposers[proposal[proposal[proposers]] == proposers]
+            match[mutual] = proposal[mutual]
+            matched[mutual] = True
+
+        representative = np.minimum(np.arange(n), match)
+        coarse_vertices, parent = np.unique(representative, return_inverse=True)
+
+        sources, targets = parent[self.sources], parent[self.targets]
+        kept = sources != targets
+        sources, targets, weights = sources[kept], targets[kept], self.weights[kept]
+        lo, hi = np.minimum(sources, targets), np.maximum(sources, targets)
+        order = np.lexsort((-weights, hi, lo))      # heaviest first within each coarse edge
+        lo, hi, weights = lo[order], hi[order], weights[order]
+        first = np.r_[True, (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])]
+
+        vertex_weights = None
+        if self.weighted_vertices:
+            vertex_weights = np.bincount(parent, self.vertex_weight_array, len(coarse_vertices))
+        coarse_graph = Graph.from_arrays(
+            [self.vertices[i] for i in coarse_vertices], lo[first], hi[first], weights[first], vertex_weights
+        )
+        return coarse_graph, parent
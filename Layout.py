@@ -0,0 +1,78 @@
+import argparse
+import csv
+
+from Physics import System
+from Graphs import Graph, BINARY_EXTENSION
+from Placement import PLACEMENTS
+from Checkpoint import Checkpoint
+
+
+# Headless layout: steps a System as fast as possible, without a display or frame-rate throttling
+
+DEFAULT_TIMESTEP = 0.05
+DEFAULT_MAX_STEPS = 10000
+DEFAULT_TOLERANCE = 1e-4        # converged once no body moves further than this in one step (meters)
+
+
+# Returns the number of steps taken
+def compute_layout(system, max_steps=DEFAULT_MAX_STEPS, tolerance=DEFAULT_TOLERANCE, timestep=DEFAULT_TIMESTEP):
+    for step in range(max_steps):
+        system.step(timestep)
+        if system.asleep or system.max_displacement < tolerance:
+            return step + 1
+    return max_steps
+
+
+def write_positions(system, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label', 'x', 'y'])
+        for b, (x, y) in zip(system.bodies, system.positions.tolist()):
+            writer.writerow([b.label, x, y])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute a force-directed layout without opening a window.')
+    parser.add_argument('edge_list', help=f'edge list file with "source target [weight]" per line, or a {BINARY_EXTENSION} file')
+    parser.add_argument('output', help='CSV file to write final "label,x,y" positions to')
+    parser.add_argument('--delimiter', default=None, help='field delimiter (default: by file extension, else any whitespace)')
+    parser.add_argument('--header', action='store_true', help='skip the first line of the input files')
+    parser.add_argument('--vertex-weights', default=None, help='file with "vertex weight" per line')
+    parser.add_argument('--save-binary', default=None, help=f'also save the loaded graph to this {BINARY_EXTENSION} file')
+    parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--timestep', type=float, default=DEFAULT_TIMESTEP)
+    parser.add_argument('--fixed-timestep', action='store_true', help='disable adaptive timestep control')
+    parser.add_argument('--spring-length', type=float, default=1)
+    parser.add_argument('--placement', choices=sorted(PLACEMENTS), default='random', help='initial placement of the bodies')
+    parser.add_argument('--repulsion-mode', choices=['exact', 'barnes_hut'], default=None)
+    parser.add_argument('--theta', type=float, default=None, help='Barnes-Hut opening angle')
+    parser.add_argument('--warm-start', default=None, help='checkpoint (.npz) to start from; new vertices are placed near their neighbours')
+    parser.add_argument('--save-checkpoint', default=None, help='also save the final state to this .npz checkpoint')
+    args = parser.parse_args()
+
+    if args.edge_list.endswith(BINARY_EXTENSION):
+        graph = Graph.load_binary(args.edge_list)
+    else:
+        graph = Graph.from_edge_list(args.edge_list, args.delimiter, args.vertex_weights, args.header)
+    if args.save_binary:
+        graph.save_binary(args.save_binary)
+    system = System.from_graph(graph, spring_length_function=lambda w: args.spring_length, placement=args.placement)
+    if args.warm_start:
+        matched = Checkpoint.load(args.warm_start).apply(system)
+        print(f'{matched} of {len(system.bodies)} bodies restored from {args.warm_start}')
+    system.adaptive_timestep = not args.fixed_timestep
+    if args.repulsion_mode:
+        system.repulsion_mode = args.repulsion_mode
+    if args.theta is not None:
+        system.barnes_hut_theta = args.theta
+
+    steps = compute_layout(system, args.max_steps, args.tolerance, args.timestep)
+    write_positions(system, args.output)
+    if args.save_checkpoint:
+        Checkpoint.from_system(system).save(args.save_checkpoint)
+    print(f'{len(system.bodies)} bodies, {len(system.springs)} springs, {steps} steps')
+
+
+if __name__ == '__main__':
+    main()
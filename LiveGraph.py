@@ -0,0 +1,99 @@
+import numpy as np
+
+from Physics import Body, Spring, BODY_DENSITY
+
+
+SEED_JITTER = 0.1       # meters; spreads out bodies seeded at the same neighbour centroid
+SPRING_DAMPING = 0.5    # as in System.from_graph
+
+
+# Graph-level edits of a running System: vertices and edges are named by label, and weights are turned
+# into masses, spring lengths and stiffnesses with the same functions as System.from_graph. Each edit
+# costs amortized O(1) (O(degree) to find or remove a vertex's edges) and wakes only the bodies whose
+# forces it changes; the rest of the layout stays asleep unless they push it.
+# While a PhysicsWorker runs the system, edits must be submitted to it.
+class LiveGraph:
+    def __init__(self, system, spring_length_function=lambda w: 1, k_function=lambda w: w, mass_function=lambda w: w):
+        self.system = system
+        self.spring_length_function = spring_length_function
+        self.k_function = k_function
+        self.mass_function = mass_function
+        self.bodies = {b.label: b for b in system.bodies}   # label -> Body
+        self.unplaced = set()       # bodies added without neighbours, seeded again at their first edge
+        self.rng = np.random.default_rng()
+
+    def body(self, label):
+        if str(label) not in self.bodies:
+            raise Exception(f'Unknown vertex: {label}')
+        return self.bodies[str(label)]
+
+    # Centroid of the given bodies (default the whole layout) plus jitter
+    def seed_position(self, neighbors=None):
+        positions = self.system.positions
+        if neighbors:
+            center = positions[[b.index for b in neighbors]].mean(axis=0)
+        else:
+            center = positions.mean(axis=0) if len(positions) else np.zeros(2)
+        return center + self.rng.normal(0, SEED_JITTER, 2)
+
+    # neighbors should be of form
+    # [(label, edge_weight), ...]
+    # The new body is seeded at the centroid of its neighbours.
+    def add_vertex(self, label, weight=1, neighbors=()):
+        label = str(label)
+        if label in self.bodies:
+            raise Exception(f'Duplicate vertex: {label}')
+        neighbors = [(self.body(v), w) for v, w in neighbors]
+        placed = [b for b, _ in neighbors if b not in self.unplaced]
+        body = Body(tuple(self.seed_position(placed)), self.mass_function(weight), label=label)
+        self.system.add_body(body)
+        self.bodies[label] = body
+        if not placed:
+            self.unplaced.add(body)
+        for neighbor, w in neighbors:
+            self.add_edge(label, neighbor.label, w)
+        return body
+
+    def remove_vertex(self, label):
+        body = self.body(label)
+        del self.bodies[body.label]
+        self.unplaced.discard(body)
+        self.system.remove_body(body)
+
+    # Vertex weights only change the body's mass (and with it its charge and radius, as in Body)
+    def set_vertex_weight(self, label, weight):
+        i = self.body(label).index
+        mass = self.mass_function(weight)
+        self.system.masses[i] = mass
+        self.system.charges[i] = mass ** (1 / 2)
+        self.system.radii[i] = (mass ** (1 / 2)) / BODY_DENSITY
+        self.system.wake_bodies([i])
+
+    def add_edge(self, source, target, weight=1):
+        a, b = self.body(source), self.body(target)
+        for body, other in [(a, b), (b, a)]:
+            if body in self.unplaced and other not in self.unplaced:
+                self.system.positions[body.index] = self.seed_position([other])
+                self.system.grid.update(self.system.positions, [body.index])
+                self.unplaced.discard(body)
+        spring = Spring((a, b), self.spring_length_function(weight), self.k_function(weight), SPRING_DAMPING)
+        self.system.add_spring(spring)
+        return spring
+
+    def find_edge(self, source, target):
+        a, b = self.body(source), self.body(target)
+        for j in self.system.springs_of(a.index):
+            spring = self.system.springs[j]
+            if set(spring.endpoints) == {a, b}:
+                return spring
+        raise Exception(f'Unknown edge: {source} - {target}')
+
+    def remove_edge(self, source, target):
+        self.system.remove_spring(self.find_edge(source, target))
+
+    def set_edge_weight(self, source, target, weight):
+        spring = self.find_edge(source, target)
+        j = spring.index
+        self.system.spring_lengths[j] = self.spring_length_function(weight)
+        self.system.spring_ks[j] = self.k_function(weight)
+        self.system.wake_bodies(self.system.spring_endpoints[j])
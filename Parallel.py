@@ -0,0 +1,202 @@
+import os
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from BarnesHut import QuadTree, barnes_hut_repulsion
+from Physics import exact_repulsion
+
+
+TILES_PER_PROCESS = 4       # tiles of bodies per worker process and step, to even out the load
+
+# System arrays moved into shared memory, so the workers read the live state without a copy per step
+SHARED_BODY_ARRAYS = ['positions', 'velocities', 'charges']
+SHARED_SPRING_ARRAYS = ['spring_lengths', 'spring_ks', 'spring_dampings']
+
+
+# numpy array backed by a block of shared memory; created when name is None, otherwise attached to
+class SharedArray:
+    def __init__(self, shape, dtype, name=None):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self.shm = SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(shape, dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        return (self.shm.name, self.array.shape, self.array.dtype.str)
+
+    def close(self, unlink=False):
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass        # a view of the array is still alive; the mapping is released with it
+        if unlink:
+            self.shm.unlink()
+
+
+# Spring forces on the given bodies, from a CSR adjacency (offsets, others, springs) listing both
+# directions of every spring. Equal to System.spring_forces at those bodies.
+def incident_spring_forces(rows, offsets, others, springs, positions, velocities, lengths, ks, dampings):
+    counts = offsets[rows + 1] - offsets[rows]
+    edges = np.repeat(offsets[rows] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    bodies, others, springs = np.repeat(rows, counts), others[edges], springs[edges]
+    disp = positions[others] - positions[bodies]
+    length_sq = np.einsum('ij,ij->i', disp, disp)
+    length = np.sqrt(length_sq)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hookian = (length - lengths[springs]) * ks[springs] / length
+        rel_vel = velocities[bodies] - velocities[others]
+        damping = np.einsum('ij,ij->i', rel_vel, disp) / length_sq * dampings[springs]
+    magnitude = np.where(length_sq > 0, hookian - damping, 0)
+    slots = np.repeat(np.arange(len(rows)), counts)
+    return np.column_stack([np.bincount(slots, disp[:, axis] * magnitude, minlength=len(rows)) for axis in range(2)])
+
+
+# Shared arrays attached in this worker process, by shared memory name, and the quadtree of the current step
+worker_arrays = {}
+worker_tree = {}
+
+
+def attach(specs):
+    for name in set(worker_arrays) - {spec[0] for spec in specs.values()}:
+        worker_arrays.pop(name).close()     # replaced by the main process
+    for name, shape, dtype in specs.values():
+        if name not in worker_arrays:
+            worker_arrays[name] = SharedArray(shape, dtype, name)
+    return {key: worker_arrays[spec[0]].array for key, spec in specs.items()}
+
+
+# Computes the total force on the active bodies of one tile [start, end) into the shared forces array
+def tile_forces(task):
+    specs, step, n, start, end, mode, theta, coefficient = task
+    arrays = attach(specs)
+    rows = start + np.flatnonzero(arrays['active'][start:end])
+    if len(rows) == 0:
+        return
+    positions, charges = arrays['positions'][:n], arrays['charges'][:n]
+    if mode == 'barnes_hut':
+        if worker_tree.get('step') != step:
+            worker_tree.update(step=step, tree=QuadTree(positions, charges) if n >= 2 else None)
+        repulsion = barnes_hut_repulsion(positions, charges, theta, rows, worker_tree['tree'])
+    elif mode == 'exact':
+        repulsion = exact_repulsion(positions, charges, rows)
+    else:
+        raise Exception(f'Unknown repulsion mode: {mode}')
+    arrays['forces'][rows] = repulsion[rows] * coefficient + incident_spring_forces(
+        rows, arrays['offsets'], arrays['others'], arrays['springs'], positions, arrays['velocities'][:n],
+        arrays['spring_lengths'], arrays['spring_ks'], arrays['spring_dampings']
+    )
+
+
+# Computes the spring and repulsion forces of a System in worker processes. The bodies are split into
+# tiles; each worker computes the total force on the bodies of a tile, reading the positions from
+# shared memory and writing its rows of a shared force array, so nothing needs to be reduced or copied.
+# Attaching moves the system's position, velocity, charge and spring arrays into shared memory; they
+# are moved out again (and the processes stopped) by close.
+#     with ParallelForces(system):
+#         system.step(...)
+class ParallelForces:
+    def __init__(self, system, processes=None, tiles_per_process=TILES_PER_PROCESS):
+        self.system = system
+        self.processes = processes or os.cpu_count()
+        self.tiles = self.processes * tiles_per_process
+        resource_tracker.ensure_running()   # shared by the workers, so they do not clean up blocks they attached to
+        self.pool = Pool(self.processes)
+        self.shared = {}                    # key -> SharedArray
+        self.structure_version = None       # of the system when the adjacency was built
+        self.steps = 0
+        system.parallel_forces = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def replace(self, key, shared):
+        if key in self.shared:
+            self.shared[key].close(unlink=True)
+        self.shared[key] = shared
+
+    # Moves the system's arrays into shared memory, again whenever the system outgrew a buffer
+    def share_system_arrays(self):
+        system = self.system
+        for buffers, names in [(system.body_buffers, SHARED_BODY_ARRAYS), (system.spring_buffers, SHARED_SPRING_ARRAYS)]:
+            stale = [name for name in names if name not in self.shared or buffers[name] is not self.shared[name].array]
+            if not stale:
+                continue
+            size = len(getattr(system, names[0]))
+            replaced = {}
+            for name in stale:
+                replaced[name] = SharedArray(buffers[name].shape, buffers[name].dtype)
+                replaced[name].array[:] = buffers[name]
+                buffers[name] = replaced[name].array
+            system.resize_arrays(buffers, size)
+            for name, shared in replaced.items():
+                self.replace(name, shared)
+
+    # Both directions of every spring, grouped by body
+    def share_adjacency(self):
+        system = self.system
+        n, m = len(system.bodies), len(system.springs)
+        a, b = system.spring_endpoints.T
+        bodies, others = np.r_[a, b], np.r_[b, a]
+        order = np.argsort(bodies, kind='stable')
+        offsets = np.zeros(n + 1, dtype=np.intp)
+        offsets[1:] = np.cumsum(np.bincount(bodies, minlength=n))
+        for key, array in [('offsets', offsets), ('others', others[order]), ('springs', np.r_[np.arange(m), np.arange(m)][order])]:
+            shared = SharedArray(array.shape, array.dtype)
+            shared.array[:] = array
+            self.replace(key, shared)
+        self.structure_version = system.structure_version
+
+    # Scratch arrays sized to the system's body capacity
+    def share_scratch(self):
+        capacity = len(self.system.body_buffers['positions'])
+        if 'forces' not in self.shared or len(self.shared['forces'].array) != capacity:
+            self.replace('active', SharedArray((capacity,), bool))
+            self.replace('forces', SharedArray((capacity, 2), float))
+
+    # Total force on the active bodies (other rows are left undefined), as System.integrate computes it
+    def forces(self, active):
+        system = self.system
+        n = len(system.bodies)
+        self.share_system_arrays()
+        if self.structure_version != system.structure_version:
+            self.share_adjacency()
+        self.share_scratch()
+        self.shared['active'].array[:n] = active
+
+        specs = {key: shared.spec for key, shared in self.shared.items()}
+        bounds = np.linspace(0, n, self.tiles + 1).astype(int).tolist()
+        tasks = [
+            (specs, self.steps, n, start, end, system.repulsion_mode, system.barnes_hut_theta, system.repulsion_coefficient)
+            for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+        ]
+        self.pool.map(tile_forces, tasks, chunksize=1)
+        self.steps += 1
+
+        forces = self.shared['forces'].array[:n]
+        if system.repulsion_mode == 'barnes_hut' and active.all() and n >= 2:
+            forces -= forces.mean(axis=0)   # as barnes_hut_repulsion does for a full pass (spring forces sum to zero)
+        return forces
+
+    # Stops the workers and moves the system's arrays back into private memory
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        system = self.system
+        for buffers, names in [(system.body_buffers, SHARED_BODY_ARRAYS), (system.spring_buffers, SHARED_SPRING_ARRAYS)]:
+            size = len(getattr(system, names[0]))
+            for name in names:
+                buffers[name] = buffers[name].copy()
+            system.resize_arrays(buffers, size)
+        for shared in self.shared.values():
+            shared.close(unlink=True)
+        self.shared.clear()
+        if system.parallel_forces is self:
+            system.parallel_forces = None
@@ -1,18 +1,104 @@
+import numpy as np
 from pygame.math import Vector2 as V2
 from random import randint, choice, sample, uniform
 from string import ascii_lowercase
 
+from Animation import Animation
+from BarnesHut import barnes_hut_repulsion
+from Placement import PLACEMENTS
+from Profiling import profiler
+from Spatial import SpatialGrid
+
 
 BODY_DENSITY = 5.0
 AGITATION_MAGNITUDE = 1
+REPULSION_BLOCK_SIZE = 1 << 20     # max number of body pairs evaluated at once
+
+# Adaptive timestep
+MIN_TIMESTEP_SCALE = 0.1
+MAX_TIMESTEP_SCALE = 4.0
+TIMESTEP_INCREASE = 1.05        # applied while the motion stays within the limits below
+TIMESTEP_DECREASE = 0.7         # applied when the kinetic energy jumps or bodies move too far
+MAX_ENERGY_GROWTH = 1.5         # per step
+MAX_STEP_DISPLACEMENT = 0.2     # meters per step
+STABILITY_FACTOR = 1.0          # fraction of the explicit integration limit 2 * sqrt(m / k)
+
+# Sleeping
+SLEEP_VELOCITY = 1e-3           # meters per second
+SLEEP_ACCELERATION = 1e-3       # meters per second squared
+SLEEP_STEPS = 30                # consecutive still steps before a body sleeps
 
 # Initial Values
 FRICTION_COEFFICIENT = 0.1
 REPULSION_COEFFICIENT = 0.1
+REPULSION_MODE = 'exact'        # 'exact' or 'barnes_hut'
+BARNES_HUT_THETA = 0.5          # opening angle; 0 is exact, larger is faster and less accurate
+
+# System arrays with one row per body / per spring
+BODY_ARRAYS = ['positions', 'velocities', 'masses', 'charges', 'radii', 'locked', 'colors', 'awake', 'still_steps']
+SPRING_ARRAYS = ['spring_lengths', 'spring_ks', 'spring_dampings', 'spring_endpoints']
+
+
+def to_vector(value):
+    return V2(*value)
+
+
+def to_array_value(value):
+    return tuple(value) if isinstance(value, V2) else value
+
+
+def to_color(value):
+    return tuple(int(c) for c in value)
+
+
+# Attribute stored in one of the owning System's arrays (at the object's index).
+# Before the object is added to a System the value is kept on the object itself.
+class ArrayAttribute:
+    def __init__(self, array_name, convert=float, on_change=None):
+        self.array_name = array_name
+        self.convert = convert
+        self.on_change = on_change      # name of a method of the object to call after the value is changed
+
+    def __set_name__(self, owner, name):
+        self.local_name = '_' + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj.system is None:
+            return getattr(obj, self.local_name)
+        return self.convert(getattr(obj.system, self.array_name)[obj.index])
+
+    def __set__(self, obj, value):
+        if obj.system is None:
+            setattr(obj, self.local_name, self.convert(value))
+        else:
+            getattr(obj.system, self.array_name)[obj.index] = to_array_value(value)
+            if self.on_change:
+                getattr(obj, self.on_change)()
+
+
+# Copies the array attributes of a body or spring being removed from its System back onto the object
+def detach(obj):
+    names = [name for name, attr in vars(type(obj)).items() if isinstance(attr, ArrayAttribute)]
+    values = [getattr(obj, name) for name in names]
+    obj.system, obj.index = None, None
+    for name, value in zip(names, values):
+        setattr(obj, name, value)
 
 
 class Body:
+    pos = ArrayAttribute('positions', to_vector, on_change='moved')
+    vel = ArrayAttribute('velocities', to_vector, on_change='wake')
+    mass = ArrayAttribute('masses', on_change='wake')
+    charge = ArrayAttribute('charges', on_change='wake')
+    radius = ArrayAttribute('radii')
+    locked = ArrayAttribute('locked', bool, on_change='wake')
+    color = ArrayAttribute('colors', to_color)
+
     def __init__(self, pos, mass, radius=None, color=None, label=None):
+        self.system = None      # set once the body is added to a System
+        self.index = None
         self.mass = mass
         self.radius = radius if radius else (mass ** (1 / 2)) / BODY_DENSITY
         self.color = (randint(127, 255), randint(127, 255), randint(127, 255))
@@ -36,38 +122,74 @@ class Body:
     def update_position(self, timestep):
         self.pos += self.vel * timestep
 
+    def wake(self):
+        if self.system is not None:
+            self.system.wake([self.index])
+
+    def moved(self):
+        if self.system is not None:
+            self.system.wake([self.index])
+            self.system.grid.update(self.system.positions, [self.index])
+
 
 class Spring:
+    length = ArrayAttribute('spring_lengths', on_change='wake')
+    k = ArrayAttribute('spring_ks', on_change='wake')
+    damping = ArrayAttribute('spring_dampings', on_change='wake')
+
     def __init__(self, endpoints, length, k, damping):
+        self.system = None
+        self.index = None
         self.endpoints = endpoints
         self.length = length
         self.k = k
         self.damping = damping
 
+    def wake(self):
+        if self.system is not None:
+            self.system.wake([b.index for b in self.endpoints])
+
 
 def projection(a, b):
     return b * (a.dot(b) / b.length_squared())
 
 
-def color_from_value(value):
-    # non-linear scale from blue (0) to red (1)
-    x = value ** 0.5
-    return (255 * x, 0, 255 * (1 - x))
+# Exact pairwise repulsion (coefficient not applied) on the target bodies (default all), evaluated in blocks of rows
+def exact_repulsion(positions, charges, targets=None):
+    n = len(positions)
+    targets = np.arange(n) if targets is None else targets
+    forces = np.zeros_like(positions)
+    block_rows = max(1, REPULSION_BLOCK_SIZE // max(n, 1))
+    for start in range(0, len(targets), block_rows):
+        rows = targets[start:start + block_rows]
+        disp = positions[rows, None, :] - positions[None, :, :]
+        dist_sq = np.einsum('ijk,ijk->ij', disp, disp)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            magnitude = charges[rows, None] * charges[None, :] / dist_sq
+        magnitude[dist_sq == 0] = 0      # a body does not repel itself (or bodies on top of it)
+        forces[rows] = np.einsum('ijk,ij->ik', disp, magnitude)
+    return forces
 
 
 class System:
+    # placement names one of Placement.PLACEMENTS; positions (an array aligned with graph.vertices,
+    # or a map from vertex to position) overrides it. Bodies are created in vertex id order.
     @staticmethod
-    def from_graph(graph, spring_length_function=lambda w: 1, k_function=lambda w: w, mass_function=lambda w: w):
+    def from_graph(graph, spring_length_function=lambda w: 1, k_function=lambda w: w, mass_function=lambda w: w,
+                   placement='random', positions=None):
+        if positions is None:
+            positions = PLACEMENTS[placement](graph, spring_length_function, k_function, mass_function)
+        elif isinstance(positions, dict):
+            positions = np.array([tuple(positions[v]) for v in graph.vertices], dtype=float).reshape(-1, 2)
         if graph.weighted_vertices:
-            body_map = {v[0]: Body((uniform(1, 7), uniform(1, 5)), mass_function(v[1]), label=str(v[0])) for v in graph.vertex_weights}
+            masses = [mass_function(w) for w in graph.vertex_weight_array.tolist()]
         else:
-            body_map = {v: Body((uniform(1, 7), uniform(1, 5)), 1, label=str(v)) for v in graph.vertices}
-        
-        bodies = list(body_map.values())
-        print(bodies)
+            masses = [1] * len(graph.vertices)
+
+        bodies = [Body(pos, mass, label=str(v)) for v, pos, mass in zip(graph.vertices, positions.tolist(), masses)]
         springs = [
-            Spring((body_map[e[0]], body_map[e[1]]), spring_length_function(e[2]), k_function(e[2]), 0.5)
-            for e in graph.edges
+            Spring((bodies[a], bodies[b]), spring_length_function(w), k_function(w), 0.5)
+            for a, b, w in zip(graph.sources.tolist(), graph.targets.tolist(), graph.weights.tolist())
         ]
         return System(bodies, springs)
     
@@ -89,75 +211,368 @@ class System:
     def __init__(self, bodies, springs):
         self.bodies = bodies
         self.springs = springs
+
+        # body and spring state is kept in contiguous arrays; Body and Spring objects are views onto them
+        n, m = len(bodies), len(springs)
+        self.positions = np.array([tuple(b.pos) for b in bodies], dtype=float).reshape(n, 2)
+        self.velocities = np.array([tuple(b.vel) for b in bodies], dtype=float).reshape(n, 2)
+        self.masses = np.array([b.mass for b in bodies], dtype=float)
+        self.charges = np.array([b.charge for b in bodies], dtype=float)
+        self.radii = np.array([b.radius for b in bodies], dtype=float)
+        self.locked = np.array([b.locked for b in bodies], dtype=bool)
+        self.colors = np.array([b.color for b in bodies], dtype=np.uint8).reshape(n, 3)
+        self.awake = np.ones(n, dtype=bool)
+        self.still_steps = np.zeros(n, dtype=int)
+        for i, b in enumerate(bodies):
+            b.system, b.index = self, i
+
+        self.spring_lengths = np.array([s.length for s in springs], dtype=float)
+        self.spring_ks = np.array([s.k for s in springs], dtype=float)
+        self.spring_dampings = np.array([s.damping for s in springs], dtype=float)
+        self.spring_endpoints = np.array([(s.endpoints[0].index, s.endpoints[1].index) for s in springs], dtype=np.intp).reshape(m, 2)
+        for i, s in enumerate(springs):
+            s.system, s.index = self, i
+
+        # the arrays above are views onto buffers with spare capacity, so that bodies and springs can be
+        # added in amortized O(1); incident_springs (spring indices of each body) is built on first use
+        self.body_buffers = {name: getattr(self, name) for name in BODY_ARRAYS}
+        self.spring_buffers = {name: getattr(self, name) for name in SPRING_ARRAYS}
+        self.incident_springs = None
+        self.structure_version = 0      # incremented whenever a body or spring is added or removed
+
+        self.grid = SpatialGrid(self.positions)
+
         self.repulsion_coefficient = REPULSION_COEFFICIENT
+        self.repulsion_mode = REPULSION_MODE
+        self.barnes_hut_theta = BARNES_HUT_THETA
+
+        self.adaptive_timestep = False
+        self.timestep_scale = 1.0
+        self.sleep_enabled = True
+        self.kinetic_energy = 0.0
+        self.max_displacement = 0.0     # furthest any body moved during the last step
         self.friction_coefficient = FRICTION_COEFFICIENT
 
-        self.animation_data = None
+        self.parallel_forces = None     # ParallelForces computing the force passes in worker processes, if set
+
+        self.animation_data = None      # Animation compiled by add_animation_data or opened by load_animation_data
         self.animation_playing = False
         self.animation_clock = 0
     
     # data should be of form
     # [(body_label, [(time, value), ...]), ...]
+    # bodies without data keep their color
     def add_animation_data(self, data, time_scale=1):
-        self.animation_data = {}
-        for entry in data:
-            label, points = entry
-            self.animation_data[label] = [(p[0] * time_scale, p[1]) for p in points]
-        print(self.animation_data)
+        body_index = {b.label: b.index for b in self.bodies}
+        self.animation_data = Animation.from_series(data, body_index, time_scale)
+
+    # Plays back an animation file (see AnimationWriter) from disk, paging it in around animation_clock
+    def load_animation_data(self, path, time_scale=1):
+        body_index = {b.label: b.index for b in self.bodies}
+        self.animation_data = Animation.load(path, body_index, time_scale)
+
+    def save_animation_data(self, path):
+        bodies = self.animation_data.bodies.tolist()
+        self.animation_data.save(path, [self.bodies[i].label if i >= 0 else None for i in bodies])
     
     def get_bodies_at(self, pos):
-        return [b for b in self.bodies if (pos - b.pos).length() <= b.radius]
+        pos = np.array(tuple(pos))
+        max_radius = self.radii.max(initial=0)
+        candidates = self.grid.query_rect(pos - max_radius, pos + max_radius)
+        dist = np.hypot(*(self.positions[candidates] - pos).T)
+        return [self.bodies[i] for i in candidates[dist <= self.radii[candidates]]]
+
+    # Bodies whose centers lie inside the rectangle spanned by the two corners
+    def get_bodies_in_rect(self, topleft, bottomright):
+        return [self.bodies[i] for i in self.get_body_indices_in_rect(topleft, bottomright)]
+
+    def get_body_indices_in_rect(self, topleft, bottomright):
+        lo, hi = np.array(tuple(topleft)), np.array(tuple(bottomright))
+        candidates = self.grid.query_rect(lo, hi)
+        inside = ((self.positions[candidates] >= lo) & (self.positions[candidates] <= hi)).all(axis=1)
+        return candidates[inside]
+
+    # Points the named arrays at the first size rows of their buffers, doubling a buffer that is too small
+    def resize_arrays(self, buffers, size):
+        for name, buffer in buffers.items():
+            if size > len(buffer):
+                grown = np.zeros((max(size, 2 * len(buffer)),) + buffer.shape[1:], dtype=buffer.dtype)
+                grown[:len(buffer)] = buffer
+                buffers[name] = buffer = grown
+            setattr(self, name, buffer[:size])
+
+    def springs_of(self, index):
+        if self.incident_springs is None:
+            self.incident_springs = [set() for _ in self.bodies]
+            for i, (a, b) in enumerate(self.spring_endpoints.tolist()):
+                self.incident_springs[a].add(i)
+                self.incident_springs[b].add(i)
+        return self.incident_springs[index]
+
+    # Adds a body (not yet in any System) and returns its index. Only the new body is woken.
+    def add_body(self, body):
+        i = len(self.bodies)
+        self.resize_arrays(self.body_buffers, i + 1)
+        self.positions[i] = tuple(body.pos)
+        self.velocities[i] = tuple(body.vel)
+        self.masses[i] = body.mass
+        self.charges[i] = body.charge
+        self.radii[i] = body.radius
+        self.locked[i] = body.locked
+        self.colors[i] = body.color
+        self.awake[i] = True
+        self.still_steps[i] = 0
+        self.bodies.append(body)
+        body.system, body.index = self, i
+        if self.incident_springs is not None:
+            self.incident_springs.append(set())
+        self.grid.append(self.positions[i])
+        self.structure_version += 1
+        return i
+
+    # Removes a body and its springs; the last body takes its index. Its former neighbours are woken.
+    def remove_body(self, body):
+        neighbors = set()
+        while self.springs_of(body.index):
+            spring = self.springs[next(iter(self.springs_of(body.index)))]
+            neighbors.update(b for b in spring.endpoints if b is not body)
+            self.remove_spring(spring)
+
+        i, last = body.index, len(self.bodies) - 1
+        detach(body)
+        if i != last:
+            for name in BODY_ARRAYS:
+                array = getattr(self, name)
+                array[i] = array[last]
+            moved = self.bodies[last]
+            self.bodies[i], moved.index = moved, i
+            for j in self.incident_springs[last]:
+                endpoints = self.spring_endpoints[j]
+                endpoints[endpoints == last] = i
+            self.incident_springs[i] = self.incident_springs[last]
+        self.bodies.pop()
+        self.incident_springs.pop()
+        self.resize_arrays(self.body_buffers, last)
+        self.grid.swap_remove(i)
+        if self.animation_data is not None:
+            self.animation_data.remove_body(i, last)
+        self.structure_version += 1
+        self.wake_bodies([b.index for b in neighbors])
+
+    # Adds a spring (not yet in any System) between two bodies of this System and returns its index.
+    # Only its endpoints are woken; the rest of the layout follows as they move.
+    def add_spring(self, spring):
+        j = len(self.springs)
+        a, b = (body.index for body in spring.endpoints)
+        self.resize_arrays(self.spring_buffers, j + 1)
+        self.spring_lengths[j] = spring.length
+        self.spring_ks[j] = spring.k
+        self.spring_dampings[j] = spring.damping
+        self.spring_endpoints[j] = (a, b)
+        self.springs.append(spring)
+        spring.system, spring.index = self, j
+        self.springs_of(a).add(j)
+        self.springs_of(b).add(j)
+        self.structure_version += 1
+        self.wake_bodies([a, b])
+        return j
+
+    # Removes a spring; the last spring takes its index. Its endpoints are woken.
+    def remove_spring(self, spring):
+        j, last = spring.index, len(self.springs) - 1
+        a, b = self.spring_endpoints[j].tolist()
+        self.springs_of(a).discard(j)
+        self.springs_of(b).discard(j)
+        detach(spring)
+        if j != last:
+            for name in SPRING_ARRAYS:
+                array = getattr(self, name)
+                array[j] = array[last]
+            moved = self.springs[last]
+            self.springs[j], moved.index = moved, j
+            for endpoint in self.spring_endpoints[j].tolist():
+                self.incident_springs[endpoint].discard(last)
+                self.incident_springs[endpoint].add(j)
+        self.springs.pop()
+        self.resize_arrays(self.spring_buffers, last)
+        self.structure_version += 1
+        self.wake_bodies([a, b])
+
+    @property
+    def asleep(self):
+        return not self.awake.any()
+
+    @property
+    def labels(self):
+        return [b.label for b in self.bodies]
+
+    # Wakes only the given bodies
+    def wake_bodies(self, indices):
+        self.awake[indices] = True
+        self.still_steps[indices] = 0
+
+    # Wakes the given bodies (default all) and the bodies attached to them by springs
+    def wake(self, indices=None):
+        if indices is None:
+            self.awake[:] = True
+            self.still_steps[:] = 0
+            return
+        touched = np.zeros(len(self.bodies), dtype=bool)
+        touched[indices] = True
+        a, b = self.spring_endpoints.T
+        touched[b[touched[a]]] = True
+        touched[a[touched[b]]] = True
+        self.awake |= touched
+        self.still_steps[touched] = 0
+
+    def apply_impulses(self, forces, duration, active=None):
+        free = ~self.locked if active is None else active & ~self.locked
+        self.velocities[free] += forces[free] * duration / self.masses[free, None]
 
     def agitate(self):
         n = len(self.bodies)
-        forces = [V2(uniform(-1, 1), uniform(-1, 1)) * AGITATION_MAGNITUDE for _ in range(n)]
-        # ensure total momentum remains zero
-        total_force = V2(0, 0)
-        for f in forces: total_force += f
-        offset = total_force / n
-        for f in forces: f -= offset
-        for b, f in zip(self.bodies, forces):
-            b.apply_impulse(f, 1)
-    
-    def step(self, timestep):
-        for s in self.springs:
-            a, b = s.endpoints
-            disp = b.pos - a.pos
-            stretch = disp.length() - s.length
-            hookian_force = (b.pos - a.pos).normalize() * (stretch * s.k)
-            damping_force = (projection(a.vel, disp) - projection(b.vel, disp)) * s.damping
-            force = hookian_force - damping_force
-            a.apply_impulse(force, timestep)
-            b.apply_impulse(-force, timestep)
-        
-        # apply mutual repulsion
-        for i in range(len(self.bodies) - 1):
-            for j in range(i + 1, len(self.bodies)):
-                a, b = self.bodies[i], self.bodies[j]
-                disp = a.pos - b.pos
-                force = disp * (a.charge * b.charge / disp.length_squared()) * self.repulsion_coefficient
-                a.apply_impulse(force, timestep)
-                b.apply_impulse(-force, timestep)
-
-        for b in self.bodies:
-            friction = b.vel * b.mass * -self.friction_coefficient   # use b.vel.normalize() for absolute friction
-            b.apply_impulse(friction, timestep)
-            b.update_position(timestep)
-        
-        # handle animation changes
-        if self.animation_data and self.animation_playing:
-            self.animation_clock += timestep
-            for b in self.bodies:
-                points = self.animation_data[b.label]
-                point_found = False
-                for i in range(len(points) - 1):
-                    t1, v1 = points[i]
-                    t2, v2 = points[i + 1]
-                    if t1 < self.animation_clock <= t2:
-                        point_found = True
-                        value = v1 + (v2 - v1) * (self.animation_clock - t1) / (t2 - t1)   # linear interpolation
-                        break
-                if not point_found:
-                    _, value = points[-1]
-                new_color = color_from_value(value)
-                b.color = new_color
+        forces = np.random.uniform(-1, 1, (n, 2)) * AGITATION_MAGNITUDE
+        forces -= forces.mean(axis=0)   # ensure total momentum remains zero
+        self.apply_impulses(forces, 1)
+        self.wake()
+
+    # Largest timestep for which explicit integration of the stiffest body-spring pair stays stable
+    def stable_timestep(self):
+        a, b = self.spring_endpoints.T
+        stiffness = np.bincount(a, self.spring_ks, len(self.bodies)) + np.bincount(b, self.spring_ks, len(self.bodies))
+        sprung = stiffness > 0
+        if not sprung.any():
+            return np.inf
+        return STABILITY_FACTOR * 2 * np.sqrt(self.masses[sprung] / stiffness[sprung]).min()
+
+    # Only springs with at least one body in active (default all) are evaluated
+    def spring_forces(self, active=None):
+        a, b = self.spring_endpoints.T
+        if active is not None:
+            evaluated = active[a] | active[b]
+            a, b = a[evaluated], b[evaluated]
+        disp = self.positions[b] - self.positions[a]
+        length_sq = np.einsum('ij,ij->i', disp, disp)
+        length = np.sqrt(length_sq)
+        rest_length, k, damping = self.spring_lengths, self.spring_ks, self.spring_dampings
+        if active is not None:
+            rest_length, k, damping = rest_length[evaluated], k[evaluated], damping[evaluated]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hookian = (length - rest_length) * k / length
+            # damping opposes the relative velocity of the endpoints along the spring
+            rel_vel = self.velocities[a] - self.velocities[b]
+            damping = np.einsum('ij,ij->i', rel_vel, disp) / length_sq * damping
+        magnitude = np.where(length_sq > 0, hookian - damping, 0)
+        spring_forces = disp * magnitude[:, None]
+
+        forces = np.zeros_like(self.positions)
+        np.add.at(forces, a, spring_forces)
+        np.subtract.at(forces, b, spring_forces)
+        return forces
+
+    # Repulsion on the target bodies (default all)
+    def repulsion_forces(self, targets=None):
+        if self.repulsion_mode == 'barnes_hut':
+            forces = barnes_hut_repulsion(self.positions, self.charges, self.barnes_hut_theta, targets)
+        elif self.repulsion_mode == 'exact':
+            forces = exact_repulsion(self.positions, self.charges, targets)
+        else:
+            raise Exception(f'Unknown repulsion mode: {self.repulsion_mode}')
+        return forces * self.repulsion_coefficient
+
+    # Advances the active bodies; sleeping bodies exert forces but do not feel them
+    def integrate(self, timestep, active):
+        targets = np.flatnonzero(active)
+        if self.parallel_forces is not None:
+            with profiler.phase('parallel forces'):
+                forces = self.parallel_forces.forces(active)
+        else:
+            with profiler.phase('springs'):
+                forces = self.spring_forces(active)
+            with profiler.phase('repulsion'):
+                forces += self.repulsion_forces(targets)
+        with profiler.phase('integration'):
+            self.apply_forces(forces, timestep, active, targets)
+
+    # Moves the active bodies under the given forces, then updates the step statistics, the timestep scale and sleep
+    def apply_forces(self, forces, timestep, active, targets):
+        self.apply_impulses(forces, timestep, active)
+
+        # friction is proportional to velocity (use the normalized velocity for absolute friction)
+        free = active & ~self.locked
+        self.velocities[free] *= 1 - self.friction_coefficient * timestep
+        self.positions[free] += self.velocities[free] * timestep
+        self.grid.update(self.positions, np.flatnonzero(free))
+
+        speed_sq = np.einsum('ij,ij->i', self.velocities, self.velocities)
+        previous_energy = self.kinetic_energy
+        self.kinetic_energy = 0.5 * (self.masses * speed_sq).sum()
+        self.max_displacement = np.sqrt(speed_sq.max(initial=0)) * timestep
+
+        # grow the timestep while the motion stays smooth, shrink it at the first sign of instability
+        if self.adaptive_timestep:
+            unstable = self.kinetic_energy > previous_energy * MAX_ENERGY_GROWTH > 0
+            if unstable or self.max_displacement > MAX_STEP_DISPLACEMENT:
+                self.timestep_scale *= TIMESTEP_DECREASE
+            else:
+                self.timestep_scale *= TIMESTEP_INCREASE
+            self.timestep_scale = min(max(self.timestep_scale, MIN_TIMESTEP_SCALE), MAX_TIMESTEP_SCALE)
+
+        if self.sleep_enabled:
+            accel = np.sqrt(np.einsum('ij,ij->i', forces[targets], forces[targets])) / self.masses[targets]
+            still = (np.sqrt(speed_sq[targets]) < SLEEP_VELOCITY) & (accel < SLEEP_ACCELERATION)
+            still |= self.locked[targets]
+            self.still_steps[targets] = np.where(still, self.still_steps[targets] + 1, 0)
+            if not still.all():
+                self.wake(targets[~still])      # keep the neighbours of moving bodies awake
+            falling_asleep = targets[self.still_steps[targets] >= SLEEP_STEPS]
+            self.awake[falling_asleep] = False
+            self.velocities[falling_asleep] = 0
+
+    # The animation clock advances by animation_timestep, which defaults to timestep
+    def step(self, timestep, animation_timestep=None):
+        physics_timestep = timestep
+        if self.adaptive_timestep:
+            physics_timestep = min(timestep * self.timestep_scale, self.stable_timestep())
+
+        active = self.awake if self.sleep_enabled else np.ones(len(self.bodies), dtype=bool)
+        with profiler.phase('step'):
+            if active.any():
+                self.integrate(physics_timestep, active)
+            else:
+                self.kinetic_energy = 0.0
+                self.max_displacement = 0.0
+
+            # handle animation changes
+            if self.animation_data is not None and self.animation_playing:
+                with profiler.phase('animation'):
+                    self.animation_clock += timestep if animation_timestep is None else animation_timestep
+                    bodies = self.animation_data.bodies
+                    present = bodies >= 0
+                    self.colors[bodies[present]] = self.animation_data.colors_at(self.animation_clock)[present]
+
+
+# The parts of a System (or of another SystemView) that render_system reads, copied so that they stay
+# consistent while the system changes (e.g. on a PhysicsWorker's thread). Unlike a System it holds
+# only arrays and labels, so it can be pickled and sent to other processes. With bodies (sorted ids)
+# and springs, only those bodies and springs are kept; the springs' endpoints must be among the bodies.
+class SystemView:
+    def __init__(self, system, positions=None, bodies=None, springs=None):
+        positions = system.positions if positions is None else positions
+        if bodies is None:
+            self.positions = positions.copy()
+            self.radii = system.radii.copy()
+            self.colors = system.colors.copy()
+            self.locked = system.locked.copy()
+            self.labels = list(system.labels)
+            self.spring_endpoints = system.spring_endpoints.copy()
+            self.spring_ks = system.spring_ks.copy()
+            return
+        self.positions = positions[bodies]
+        self.radii = system.radii[bodies]
+        self.colors = system.colors[bodies]
+        self.locked = system.locked[bodies]
+        labels = system.labels
+        self.labels = [labels[i] for i in bodies.tolist()]
+        self.spring_endpoints = np.searchsorted(bodies, system.spring_endpoints[springs]).reshape(-1, 2)
+        self.spring_ks = system.spring_ks[springs]
@@ -0,0 +1,137 @@
+import numpy as np
+from math import sqrt
+
+
+# Initial body placements for System.from_graph.
+# Each takes the graph and the from_graph parameter functions and returns an (n, 2) array of
+# positions aligned with graph.vertices.
+
+MULTILEVEL_MIN_VERTICES = 20        # stop coarsening below this many vertices
+MULTILEVEL_MIN_REDUCTION = 0.9      # stop coarsening once a level keeps more than this fraction of vertices
+MULTILEVEL_COARSEST_STEPS = 500
+MULTILEVEL_REFINEMENT_STEPS = 50
+MULTILEVEL_JITTER = 0.1             # meters
+PIVOT_MDS_PIVOTS = 50
+SPECTRAL_ITERATIONS = 100
+SPECTRAL_TOLERANCE = 1e-6           # stop once an axis changes direction by less than this
+PLACEMENT_JITTER = 0.01             # meters; separates vertices placed on the same point
+
+
+def random_placement(graph, spring_length_function, k_function, mass_function):
+    n = len(graph.vertices)
+    return np.column_stack([np.random.uniform(1, 7, n), np.random.uniform(1, 5, n)])
+
+
+# Lays out a hierarchy of coarsened graphs from the smallest up, placing the vertices of each
+# level next to the coarse vertex they were collapsed into and briefly refining every level
+def multilevel_placement(graph, spring_length_function, k_function, mass_function):
+    from Physics import System
+    from Layout import compute_layout
+
+    levels = [graph]
+    parents = []
+    while len(levels[-1].vertices) > MULTILEVEL_MIN_VERTICES:
+        coarse_graph, parent = levels[-1].coarsen()
+        if len(coarse_graph.vertices) > MULTILEVEL_MIN_REDUCTION * len(levels[-1].vertices):
+            break
+        levels.append(coarse_graph)
+        parents.append(parent)
+
+    def relax(level, positions, max_steps):
+        system = System.from_graph(level, spring_length_function, k_function, mass_function, positions=positions)
+        system.adaptive_timestep = True
+        compute_layout(system, max_steps)
+        return system.positions
+
+    positions = relax(levels[-1], random_placement(levels[-1], spring_length_function, k_function, mass_function), MULTILEVEL_COARSEST_STEPS)
+    for level, parent, coarse_level in reversed(list(zip(levels[:-1], parents, levels[1:]))):
+        # a finer level covers more area, so spread the coarse layout out before interpolating
+        scale = sqrt(len(level.vertices) / len(coarse_level.vertices))
+        positions = positions[parent] * scale + np.random.uniform(-1, 1, (len(parent), 2)) * MULTILEVEL_JITTER
+        if level is not graph:
+            positions = relax(level, positions, MULTILEVEL_REFINEMENT_STEPS)
+    return positions
+
+
+# Rescales positions so that edges are as long as their springs on average, plus jitter
+def scale_to_spring_lengths(positions, graph, spring_length_function):
+    jitter = np.random.uniform(-1, 1, positions.shape) * PLACEMENT_JITTER
+    if len(graph.sources) == 0:
+        return positions + jitter
+    lengths = np.hypot(*(positions[graph.sources] - positions[graph.targets]).T)
+    target = np.mean([spring_length_function(w) for w in graph.weights.tolist()])
+    return (positions * (target / lengths.mean()) if lengths.mean() > 0 else positions) + jitter
+
+
+# Pivot MDS (Brandes & Pich): classical MDS restricted to the BFS distances from a few pivots, which
+# reduces to the top eigenvectors of a pivots x pivots matrix. Unreachable vertices are treated as
+# one step further than the furthest reachable one.
+def pivot_mds_placement(graph, spring_length_function, k_function, mass_function):
+    from Stress import select_pivots
+
+    n = len(graph.vertices)
+    if n < 3:
+        return random_placement(graph, spring_length_function, k_function, mass_function)
+    _, distances = select_pivots(graph, PIVOT_MDS_PIVOTS)
+    distances = distances.T.astype(float)
+    distances[distances < 0] = distances.max() + 1
+    squared = distances ** 2
+    centered = squared - squared.mean(axis=0) - squared.mean(axis=1)[:, None] + squared.mean()
+    centered *= -0.5
+    _, vectors = np.linalg.eigh(centered.T @ centered)
+    positions = centered @ vectors[:, ::-1][:, :2]
+    return scale_to_spring_lengths(positions, graph, spring_length_function)
+
+
+# Spectral layout (Koren): the two leading non-trivial eigenvectors of the transition matrix D^-1 A,
+# found by power iteration on (I + D^-1 A) / 2, keeping each axis D-orthogonal to the constant
+# vector and the earlier axis. The iteration starts from the pivot MDS axes, which are close.
+def spectral_placement(graph, spring_length_function, k_function, mass_function):
+    n = len(graph.vertices)
+    start = pivot_mds_placement(graph, spring_length_function, k_function, mass_function)
+    if n < 3:
+        return start
+    degrees = np.maximum(graph.degrees, 1).astype(float)
+    rows = np.repeat(np.arange(n), graph.degrees)
+
+    axes = [np.ones(n) / np.sqrt(degrees.sum())]
+
+    def orthogonalize(x):
+        for u in axes:
+            x -= (x @ (degrees * u)) / (u @ (degrees * u)) * u
+        return x
+
+    for axis in range(2):
+        x = orthogonalize(start[:, axis].copy())
+        if np.linalg.norm(x) <= SPECTRAL_TOLERANCE * np.linalg.norm(start[:, axis]):
+            # the pivot MDS axis lies in the span of the earlier axes (as on a path), so start elsewhere
+            x = orthogonalize(np.random.uniform(-1, 1, n))
+        x /= np.linalg.norm(x)
+        for _ in range(SPECTRAL_ITERATIONS):
+            updated = orthogonalize(0.5 * (x + np.bincount(rows, x[graph.indices], n) / degrees))
+            norm = np.linalg.norm(updated)
+            if norm <= SPECTRAL_TOLERANCE:
+                break       # x is all that is left, with eigenvalue -1 (as on a small bipartite graph)
+            updated /= norm
+            converged = x @ updated > 1 - SPECTRAL_TOLERANCE
+            x = updated
+            if converged:
+                break
+        axes.append(x)
+    positions = np.column_stack(axes[1:])
+    return scale_to_spring_lengths(positions, graph, spring_length_function)
+
+
+# Sparse stress majorization over graph-theoretic distances (see Stress.py)
+def stress_placement(graph, spring_length_function, k_function, mass_function):
+    from Stress import stress_layout
+    return stress_layout(graph, spring_length_function)
+
+
+PLACEMENTS = {
+    'random': random_placement,
+    'multilevel': multilevel_placement,
+    'stress': stress_placement,
+    'pivot_mds': pivot_mds_placement,
+    'spectral': spectral_placement
+}
@@ -0,0 +1,188 @@
+import os
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+import pygame
+
+from Physics import SystemView
+from Render import Viewport, render_system, spring_lod, LOCK_INDICATOR_WIDTH
+from UIHelpers import density_cell_size
+from Colors import WHITE
+
+
+POSTER_WIDTH = 8192             # px
+TILE_SIZE = 1024                # px
+POSTER_MARGIN = 0.02            # fraction of the layout size left empty around it
+PNG_COMPRESSION = 6             # zlib level
+PYRAMID_TILE_FILENAME = '{x}_{y}.png'
+
+
+# Viewport around every body, and the poster height in pixels for the given width
+def fit_extent(positions, radii, width):
+    radii = radii[:, None]
+    lo = (positions - radii).min(axis=0, initial=np.inf)
+    hi = (positions + radii).max(axis=0, initial=-np.inf)
+    if not np.isfinite(lo).all():
+        lo, hi = np.zeros(2), np.ones(2)
+    size = np.maximum(hi - lo, 1e-9) * (1 + 2 * POSTER_MARGIN)
+    center = (lo + hi) / 2
+    viewport = Viewport(tuple(center - size / 2), tuple(size))
+    return viewport, max(1, round(width * size[1] / size[0]))
+
+
+# Groups items by the tiles their bounding boxes (lo, hi, in poster pixels) overlap.
+# Returns CSR arrays: the items of tile t are items[starts[t]:starts[t + 1]].
+def bucket_by_tile(lo, hi, tile_size, columns, rows):
+    first = np.clip(np.floor(lo / tile_size).astype(np.int64), 0, [columns - 1, rows - 1])
+    last = np.clip(np.floor(hi / tile_size).astype(np.int64), 0, [columns - 1, rows - 1])
+    inside = ((hi >= 0) & (lo < np.array([columns, rows]) * tile_size)).all(axis=1)
+    spans = np.where(inside[:, None], last - first + 1, 0)
+    counts = spans[:, 0] * spans[:, 1]
+    items = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = first[items, 0] + offsets % spans[items, 0]
+    y = first[items, 1] + offsets // spans[items, 0]
+    tiles = y * columns + x
+    order = np.argsort(tiles, kind='stable')
+    starts = np.zeros(columns * rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tiles, minlength=columns * rows), out=starts[1:])
+    return items[order], starts
+
+
+# Writes an RGB PNG a band of rows at a time, so the whole image never has to be in memory
+class PNGWriter:
+    def __init__(self, path, width, height):
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(PNG_COMPRESSION)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, 2, 0, 0, 0]))
+
+    def write_chunk(self, kind, data):
+        self.file.write(len(data).to_bytes(4, 'big') + kind + data)
+        self.file.write(zlib.crc32(kind + data).to_bytes(4, 'big'))
+
+    # rows is a (height, width, 3) uint8 array
+    def write_rows(self, rows):
+        filtered = np.concatenate([np.zeros((len(rows), 1), dtype=np.uint8), rows.reshape(len(rows), -1)], axis=1)
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+
+# State of each rendering process, set once by init_worker so the system is only sent once per process.
+# It is sent as a SystemView, which (unlike a System) pickles under every start method.
+worker_state = {}
+
+
+def init_worker(view, topleft, meters_per_pixel, lod, density_cell, output_dir):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    worker_state.update(
+        view=view,
+        topleft=np.array(topleft),
+        meters_per_pixel=meters_per_pixel,
+        lod=lod,
+        density_cell=density_cell,
+        output_dir=output_dir
+    )
+
+
+# Renders the tile with pixel origin (x, y) and the given size. Saves it to output_dir if one was
+# given (returning None), and returns its RGB bytes otherwise.
+def render_tile(task):
+    tile_x, tile_y, x, y, width, height, bodies, springs = task
+    mpp = worker_state['meters_per_pixel']
+    view = SystemView(worker_state['view'], bodies=bodies, springs=springs)
+    viewport = Viewport(tuple(worker_state['topleft'] + np.array([x, y]) * mpp), (width * mpp, height * mpp))
+    img = pygame.Surface((width, height))
+    img.fill(WHITE)
+    render_system(view, viewport, img, lod=worker_state['lod'], density_cell=worker_state['density_cell'])
+    if worker_state['output_dir'] is None:
+        return pygame.image.tobytes(img, 'RGB')
+    pygame.image.save(img, os.path.join(worker_state['output_dir'], PYRAMID_TILE_FILENAME.format(x=tile_x, y=tile_y)))
+    return None
+
+
+# Builds every pyramid level below the full-resolution one: each tile is its (up to) four children at half size
+def build_pyramid(output_dir, levels, columns, rows, tile_size):
+    for level in range(levels - 1, 0, -1):
+        child_dir = os.path.join(output_dir, str(level))
+        parent_dir = os.path.join(output_dir, str(level - 1))
+        os.makedirs(parent_dir, exist_ok=True)
+        parent_columns, parent_rows = (columns + 1) // 2, (rows + 1) // 2
+        for y in range(parent_rows):
+            for x in range(parent_columns):
+                children = [
+                    (dx, dy, pygame.image.load(os.path.join(child_dir, PYRAMID_TILE_FILENAME.format(x=2 * x + dx, y=2 * y + dy))))
+                    for dy in range(2) for dx in range(2) if 2 * x + dx < columns and 2 * y + dy < rows
+                ]
+                width = sum(img.get_width() for dx, dy, img in children if dy == 0)
+                height = sum(img.get_height() for dx, dy, img in children if dx == 0)
+                combined = pygame.Surface((width, height))
+                for dx, dy, img in children:
+                    combined.blit(img, (dx * tile_size, dy * tile_size))
+                half = pygame.transform.smoothscale(combined, (max(1, width // 2), max(1, height // 2)))
+                pygame.image.save(half, os.path.join(parent_dir, PYRAMID_TILE_FILENAME.format(x=x, y=y)))
+        columns, rows = parent_columns, parent_rows
+
+
+# Renders the system (or the given viewport of it) width pixels wide, tile by tile in parallel, with
+# bodies and springs culled per tile. Writes either one PNG, streamed a row of tiles at a time, or
+# (with pyramid) a tile pyramid in the output directory: level 0 is a single tile and each further
+# level doubles the resolution, up to full resolution in the last. Memory use is bounded by a row of
+# tiles, not by the poster size. The spring level of detail is chosen once for the whole poster, so
+# that it does not change at tile seams. Returns the poster size in pixels.
+def render_poster(system, output_path, width=POSTER_WIDTH, viewport=None, tile_size=TILE_SIZE, processes=None, positions=None, pyramid=False):
+    positions = system.positions if positions is None else positions
+    if viewport is None:
+        viewport, height = fit_extent(positions, system.radii, width)
+    else:
+        height = max(1, round(width * viewport.dims[1] / viewport.dims[0]))
+    mpp = viewport.dims[0] / width
+    topleft = np.array(tuple(viewport.topleft))
+    columns, rows = -(-width // tile_size), -(-height // tile_size)
+
+    # spatial index: bodies and springs by the tiles their bounding boxes overlap
+    pixels = (positions - topleft) / mpp
+    radii = system.radii[:, None] / mpp + LOCK_INDICATOR_WIDTH + 2      # + anti-aliasing
+    body_items, body_starts = bucket_by_tile(pixels - radii, pixels + radii, tile_size, columns, rows)
+    a, b = system.spring_endpoints.T
+    widths = np.maximum(2, system.spring_ks / mpp / 60)[:, None] / 2 + 1     # as drawn by render_system
+    spring_items, spring_starts = bucket_by_tile(np.minimum(pixels[a], pixels[b]) - widths, np.maximum(pixels[a], pixels[b]) + widths, tile_size, columns, rows)
+    # one level of detail (and density raster cell size) for the whole poster, so that it does not change from tile to tile
+    lod = spring_lod(len(np.unique(spring_items)))
+    density_cell = density_cell_size(pixels[a], pixels[b], (width, height)) if lod == 'density' else None
+
+    def tile_task(tile_x, tile_y):
+        tile = tile_y * columns + tile_x
+        springs = spring_items[spring_starts[tile]:spring_starts[tile + 1]]
+        bodies = np.union1d(body_items[body_starts[tile]:body_starts[tile + 1]], system.spring_endpoints[springs].ravel())
+        x, y = tile_x * tile_size, tile_y * tile_size
+        return (tile_x, tile_y, x, y, min(tile_size, width - x), min(tile_size, height - y), bodies, springs)
+
+    levels = (max(columns, rows) - 1).bit_length() + 1     # until a single tile covers the poster
+    tile_dir = os.path.join(output_path, str(levels - 1)) if pyramid else None
+    if pyramid:
+        os.makedirs(tile_dir, exist_ok=True)
+    writer = None if pyramid else PNGWriter(output_path, width, height)
+    with Pool(processes, initializer=init_worker, initargs=(SystemView(system, positions), tuple(topleft), mpp, lod, density_cell, tile_dir)) as pool:
+        for tile_y in range(rows):
+            band = None if pyramid else np.empty((min(tile_size, height - tile_y * tile_size), width, 3), dtype=np.uint8)
+            tasks = [tile_task(tile_x, tile_y) for tile_x in range(columns)]
+            for (_, _, x, _, tile_width, tile_height, _, _), pixels in zip(tasks, pool.imap(render_tile, tasks)):
+                if band is not None:
+                    band[:, x:x + tile_width] = np.frombuffer(pixels, dtype=np.uint8).reshape(tile_height, tile_width, 3)
+            if writer:
+                writer.write_rows(band)
+        pool.close()
+        pool.join()
+    if writer:
+        writer.close()
+    if pyramid:
+        build_pyramid(output_path, levels, columns, rows, tile_size)
+    return width, height
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+PROFILE_WINDOW = 60             # samples per phase in the rolling averages
+TRACE_CAPACITY = 100000         # most recent timed phases kept for trace export
+
+
+# Stand-in returned while profiling is disabled, so an instrumented phase costs one method call
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+# Wall-clock timers for named phases of the hot paths, e.g.
+#     with profiler.phase('springs'):
+#         ...
+# Phases may be nested and may run on any thread.
+class Profiler:
+    def __init__(self, window=PROFILE_WINDOW, capacity=TRACE_CAPACITY):
+        self.enabled = False
+        self.window = window
+        self.durations = {}                     # phase name -> most recent durations (seconds)
+        self.events = deque(maxlen=capacity)    # (name, thread id, start, duration)
+        self.origin = time.perf_counter()
+
+    def phase(self, name):
+        return Phase(self, name) if self.enabled else NULL_PHASE
+
+    def record(self, name, start, end):
+        if name not in self.durations:
+            self.durations[name] = deque(maxlen=self.window)
+        self.durations[name].append(end - start)
+        self.events.append((name, threading.get_ident(), start, end - start))
+
+    def reset(self):
+        self.durations.clear()
+        self.events.clear()
+
+    # Mean duration (seconds) of each phase over its last window samples, in order of first appearance
+    def averages(self):
+        return {name: sum(samples) / len(samples) for name, samples in list(self.durations.items()) if samples}
+
+    # Writes the recorded phases in the Chrome trace event format (chrome://tracing, Perfetto)
+    def export_trace(self, path):
+        pid = os.getpid()
+        events = [
+            {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+            for name, tid, start, duration in list(self.events)
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+profiler = Profiler()
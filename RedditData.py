@@ -0,0 +1,272 @@
+import argparse
+import bz2
+import gzip
+import io
+import json
+import lzma
+
+import numpy as np
+
+from Graphs import Graph
+from Physics import System
+from Render import run_system
+from Export import export_system
+
+
+# Subreddit overlap graphs from newline-delimited JSON comment dumps (one comment object per line, with
+# at least "subreddit", "author" and "created_utc", as in the Pushshift dumps). Users are never stored:
+# each subreddit keeps a HyperLogLog sketch of its users (for the user count) and a MinHash signature
+# of them (for the overlap with other subreddits), so memory grows with the number of subreddits and
+# time buckets but not with the number of users or comments.
+
+HLL_PRECISION = 12          # 2^12 registers per subreddit, ~1.6% standard error on user counts
+MINHASH_SIZE = 128          # hashes per signature, ~0.09 / sqrt(overlap) relative error on overlaps
+MINHASH_SEED = 0
+MINHASH_CHUNK = 8192        # (subreddit, user) pairs hashed at once
+DUMP_CHUNK_BYTES = 1 << 24  # approximate amount of text parsed at once
+BUCKET_SECONDS = 24 * 60 * 60
+IGNORED_AUTHORS = {'[deleted]', '[removed]', 'AutoModerator'}
+
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+# Opens a dump as text, decompressing by extension (.zst needs the zstandard package)
+def open_dump(path):
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f'Reading {path} requires the zstandard package')
+        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    for extension, opener in OPENERS.items():
+        if path.endswith(extension):
+            return opener(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+# Decodes a chunk of lines in one call, falling back to line by line (skipping bad lines) if any fails
+def parse_comments(lines):
+    lines = [line for line in lines if line.strip()]
+    try:
+        return json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        comments = []
+        for line in lines:
+            try:
+                comments.append(json.loads(line))
+            except ValueError:
+                pass
+        return comments
+
+
+# Copy of array with capacity rows, the new ones set to fill
+def grow(array, capacity, fill):
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+# 64-bit hashes of user names, stable across runs (unlike hash()): FNV-1a over the characters of all
+# names at once, then the splitmix64 finalizer so every bit is well mixed (HyperLogLog needs that)
+def user_hashes(authors):
+    characters = np.array(authors, dtype=str)
+    characters = characters.view(np.uint32).reshape(len(authors), characters.itemsize // 4).astype(np.uint64)
+    hashes = np.full(len(authors), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in characters.T:
+        hashes = np.where(column != 0, (hashes ^ column) * np.uint64(0x100000001b3), hashes)   # skip padding
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+# Number of bits needed to represent each (uint64) value; 0 for 0
+def bit_lengths(values):
+    return np.frexp(values.astype(float))[1]
+
+
+# HyperLogLog cardinality estimate of each row of registers, with the small range correction
+def hll_estimate(registers):
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype(float)).sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+# Per-subreddit sketches of the comments seen so far. Feed it with read (or add_comments) and read the
+# results with graph and activity_series.
+#     stats = SubredditStats.from_dumps(['RC_2019-12.ndjson'])
+#     system = System.from_graph(stats.graph(top=20))
+#     system.add_animation_data(stats.activity_series())
+class SubredditStats:
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, precision=HLL_PRECISION, minhash_size=MINHASH_SIZE):
+        self.bucket_seconds = bucket_seconds
+        self.precision = precision
+        self.names = []                 # subreddit of each id
+        self.index = {}                 # subreddit -> id
+        self.registers = np.zeros((0, 2 ** precision), dtype=np.uint8)
+        self.signatures = np.zeros((0, minhash_size), dtype=np.uint64)
+        self.activity = {}              # time bucket -> comments per subreddit id in it
+        rng = np.random.default_rng(MINHASH_SEED)
+        self.minhash_a = rng.integers(0, 2 ** 63, minhash_size, dtype=np.uint64) * 2 + 1
+        self.minhash_b = rng.integers(0, 2 ** 63, minhash_size, dtype=np.uint64)
+
+    @staticmethod
+    def from_dumps(paths, bucket_seconds=BUCKET_SECONDS):
+        stats = SubredditStats(bucket_seconds)
+        for path in paths:
+            stats.read(path)
+        return stats
+
+    def subreddit_id(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            if len(self.names) > len(self.registers):
+                capacity = max(16, 2 * len(self.registers))
+                self.registers = grow(self.registers, capacity, 0)
+                self.signatures = grow(self.signatures, capacity, np.iinfo(np.uint64).max)
+        return self.index[name]
+
+    # Streams one dump a chunk of lines at a time; lines that are not comments are skipped
+    def read(self, path):
+        with open_dump(path) as f:
+            while True:
+                lines = f.readlines(DUMP_CHUNK_BYTES)
+                if not lines:
+                    return
+                subreddits, authors, times = [], [], []
+                for comment in parse_comments(lines):
+                    try:
+                        subreddit, author, time = comment['subreddit'], comment['author'], float(comment['created_utc'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if subreddit and author not in IGNORED_AUTHORS:
+                        subreddits.append(subreddit)
+                        authors.append(author)
+                        times.append(time)
+                self.add_comments(subreddits, authors, times)
+
+    # Adds a batch of comments, given as aligned sequences of subreddit names, user names and unix times
+    def add_comments(self, subreddits, authors, times):
+        if not len(subreddits):
+            return
+        ids = np.array([self.subreddit_id(s) for s in subreddits], dtype=np.intp)
+        buckets = np.floor_divide(np.asarray(times, dtype=float), self.bucket_seconds).astype(np.int64)
+        for bucket in np.unique(buckets).tolist():
+            counts = np.bincount(ids[buckets == bucket], minlength=len(self.names))
+            previous = self.activity.get(bucket, np.zeros(0, dtype=np.int64))
+            counts[:len(previous)] += previous
+            self.activity[bucket] = counts
+
+        # each (subreddit, user) pair once
+        users = user_hashes(authors)
+        order = np.lexsort((users, ids))
+        ids, users = ids[order], users[order]
+        first = np.r_[True, (ids[1:] != ids[:-1]) | (users[1:] != users[:-1])]
+        self.add_users(ids[first], users[first])
+
+    # Adds user hashes to the sketches of the subreddits with the given ids
+    def add_users(self, ids, users):
+        p = self.precision
+        registers = (users >> np.uint64(64 - p)).astype(np.intp)
+        ranks = (64 - p) - bit_lengths(users & np.uint64(2 ** (64 - p) - 1)) + 1
+        np.maximum.at(self.registers, (ids, registers), ranks.astype(np.uint8))
+
+        order = np.argsort(ids, kind='stable')
+        ids, users = ids[order], users[order]
+        for start in range(0, len(ids), MINHASH_CHUNK):
+            chunk_ids = ids[start:start + MINHASH_CHUNK]
+            hashes = self.minhash_a[:, None] * users[start:start + MINHASH_CHUNK] + self.minhash_b[:, None]
+            starts = np.flatnonzero(np.r_[True, chunk_ids[1:] != chunk_ids[:-1]])
+            rows = chunk_ids[starts]
+            self.signatures[rows] = np.minimum(self.signatures[rows], np.minimum.reduceat(hashes, starts, axis=1).T)
+
+    # Estimated number of distinct users of every subreddit
+    def user_counts(self):
+        return hll_estimate(self.registers[:len(self.names)])
+
+    # Estimated overlap (Jaccard index: shared users / users of either) of every pair of the given
+    # subreddit ids, as (first, second, overlap) arrays over the pairs with overlap >= min_overlap
+    def overlaps(self, ids, min_overlap=0):
+        signatures = self.signatures[ids]
+        firsts, seconds, values = [], [], []
+        for k in range(len(ids) - 1):
+            overlap = (signatures[k + 1:] == signatures[k]).mean(axis=1)
+            kept = np.flatnonzero((overlap >= min_overlap) & (overlap > 0))
+            firsts.append(np.full(len(kept), k))
+            seconds.append(k + 1 + kept)
+            values.append(overlap[kept])
+        if not values:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+        return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(values)
+
+    # Ids of the top subreddits by user count (all of them, largest first, by default)
+    def top_ids(self, top=None):
+        return np.argsort(-self.user_counts(), kind='stable')[:top]
+
+    # Graph of the top subreddits: vertex weights are user counts, edge weights overlaps
+    def graph(self, top=None, min_overlap=0):
+        ids = self.top_ids(top)
+        sources, targets, weights = self.overlaps(ids, min_overlap)
+        return Graph.from_arrays([self.names[i] for i in ids.tolist()], sources, targets, weights, self.user_counts()[ids])
+
+    # Activity of the top subreddits for System.add_animation_data: one point per time bucket (time 0
+    # is the first bucket, in units of buckets), valued by comments per user in that bucket and scaled
+    # so the most active subreddit-bucket is 1
+    def activity_series(self, top=None):
+        ids = self.top_ids(top)
+        if not self.activity:
+            return [(self.names[i], []) for i in ids.tolist()]
+        first, last = min(self.activity), max(self.activity)
+        counts = np.zeros((last - first + 1, len(ids)))
+        for bucket, bucket_counts in self.activity.items():
+            counts[bucket - first] = np.r_[bucket_counts, np.zeros(len(self.names) - len(bucket_counts))][ids]
+        values = counts / np.maximum(self.user_counts()[ids], 1)
+        values /= max(values.max(), 1e-12)
+        times = range(len(values))
+        return [(self.names[i], list(zip(times, values[:, column].tolist()))) for column, i in enumerate(ids.tolist())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and show the subreddit overlap graph of comment dumps.')
+    parser.add_argument('dumps', nargs='+', help='newline-delimited JSON comment dumps (optionally .gz, .bz2, .xz or .zst)')
+    parser.add_argument('--top', type=int, default=50, help='number of subreddits (by user count) to keep')
+    parser.add_argument('--min-overlap', type=float, default=0.005, help='drop edges with a smaller overlap')
+    parser.add_argument('--bucket-hours', type=float, default=BUCKET_SECONDS / 3600, help='length of an activity time bucket')
+    parser.add_argument('--time-scale', type=float, default=2, help='animation seconds per time bucket')
+    parser.add_argument('--edge-list', default=None, help='also write the graph to this CSV edge list (vertex weights to <edge list>.weights.csv)')
+    parser.add_argument('--export', default=None, help='render frames to this directory instead of opening a window')
+    args = parser.parse_args()
+
+    stats = SubredditStats.from_dumps(args.dumps, args.bucket_hours * 3600)
+    graph = stats.graph(args.top, args.min_overlap)
+    print(f'{len(stats.names)} subreddits, {len(graph.vertices)} kept, {len(graph.sources)} edges, {len(stats.activity)} time buckets')
+    if args.edge_list:
+        with open(args.edge_list, 'w') as f:
+            f.writelines(f'{a},{b},{w}\n' for a, b, w in graph.edges)
+        with open(args.edge_list + '.weights.csv', 'w') as f:
+            f.writelines(f'{v},{w}\n' for v, w in graph.vertex_weights)
+
+    # as in RedditDataTesting.py, with the stiffness exponent scaled so the largest overlap gets k = 8
+    max_overlap = max(graph.weights.max(initial=0), 1e-12)
+    system = System.from_graph(
+        graph,
+        k_function=lambda w: 2 ** (3 * w / max_overlap),
+        mass_function=lambda w: w ** 0.2 / 3
+    )
+    system.add_animation_data(stats.activity_series(args.top), time_scale=args.time_scale)
+    if args.export:
+        export_system(system, args.export)
+    else:
+        run_system(system)
+
+
+if __name__ == '__main__':
+    main()
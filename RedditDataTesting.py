@@ -1,5 +1,8 @@
 from Render import *
 from Graphs import Graph
+from Export import export_system
+
+import sys
 
 from random import random
 
@@ -46,6 +49,12 @@ from random import random
 # run_system(system)
 
 
+# Graphs and activity series like the ones below can be built from comment dumps with RedditData.py:
+# stats = SubredditStats.from_dumps(['RC_2019-12.ndjson'])
+# politics_graph = stats.graph(top=11)
+# system.add_animation_data(stats.activity_series(top=11), time_scale=2)
+
+
 politics_graph = Graph(
     ['worldpolit', 'politics', 'republican', 'democrats', 'obama', 'JoeBiden', 'ElizabethW', 'SandersFor', 'BaemyKloba', 'YangForPre', 'the_donald'],
     [('worldpolit', 'politics', 0.03729777879945979), ('worldpolit', 'SandersFor', 0.031969712903565047), ('worldpolit', 'the_donald', 0.018477991576513336), ('politics', 'SandersFor', 0.05059542561905362), ('politics', 'the_donald', 0.019278749458998448), ('politics', 'YangForPre', 0.017507183908045978), ('republican', 'democrats', 0.01270772238514174), ('republican', 'the_donald', 0.006955701612190162), ('republican', 'JoeBiden', 0.0036481556546412645), ('democrats', 'ElizabethW', 0.02046783625730994), ('democrats', 'JoeBiden', 0.018742442563482467), ('democrats', 'SandersFor', 0.012114582067177181), ('obama', 'BaemyKloba', 0.0055248618784530384), ('obama', 'JoeBiden', 0.0044444444444444444), ('obama', 'ElizabethW', 0.0019831432821021317), ('JoeBiden', 'ElizabethW', 0.030831099195710455), ('JoeBiden', 'BaemyKloba', 0.008115419296663661), ('JoeBiden', 'SandersFor', 0.0066499697728646685), ('ElizabethW', 'SandersFor', 0.03378405014388773), ('ElizabethW', 'YangForPre', 0.017729482413497283), ('ElizabethW', 'BaemyKloba', 0.00448654037886341), ('SandersFor', 'YangForPre', 0.025429920197819488), ('SandersFor', 'the_donald', 0.010861973901856276), ('SandersFor', 'BaemyKloba', 0.0009689068968554567), ('BaemyKloba', 'YangForPre', 0.001540939973383764), ('BaemyKloba', 'the_donald', 0.0003354067569215758), ('YangForPre', 'the_donald', 0.004724613293637952)],
@@ -110,4 +119,9 @@ system.add_animation_data([
 #     ('the_donald', random_points(n))
 # ], time_scale=2)
 
-run_system(system)
\ No newline at end of file
+# python RedditDataTesting.py --export   renders frames/ (and politics.mp4 if ffmpeg is installed)
+if __name__ == '__main__':
+    if '--export' in sys.argv:
+        export_system(system, 'frames', video_path='politics.mp4')
+    else:
+        run_system(system)
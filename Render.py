@@ -1,5 +1,6 @@
 import pygame
 import pygame.gfxdraw
+import numpy as np
 from pygame.math import Vector2 as V2
 from random import randint, choice, sample, uniform
 from functools import lru_cache
@@ -9,15 +10,30 @@ from UIHelpers import *
 from UIElements import *
 from Colors import *
 from Images import *
+from Simulation import PhysicsWorker
+from Profiling import profiler
 
 TARGET_FPS = 60
-TIMESTEP_PER_FRAME = 0.05
 VIEWPORT_SHIFT_SPEED = 0.01     # viewport widths
 VIEWPORT_ZOOM_FACTOR = 1.1
 CONSTANT_SCALE_FACTOR = 1.1
 
 MIN_SCREEN_WIDTH = 160          # px
 MIN_SCREEN_HEIGHT = 120         # px
+IDLE_POLL_MS = 100              # while idle, waiting for input times out this often to catch changes made without input
+
+# Profiling
+PROFILE_OVERLAY_INTERVAL = 15   # frames between overlay updates
+PROFILE_TRACE_PATH = 'profile_trace.json'
+
+# Level of detail
+POINT_RADIUS_PX = 1             # bodies with a smaller on-screen radius are drawn as single pixels
+ANTIALIAS_RADIUS_PX = 4         # bodies with a smaller on-screen radius are drawn without anti-aliasing
+DENSITY_SPRING_COUNT = 20000    # with more visible springs than this, springs are drawn as a density raster
+THIN_SPRING_BATCH_COUNT = 100   # with at least this many visible 2 px springs, they are drawn in one batch
+LOCK_INDICATOR_WIDTH = 3        # px
+
+label_cache = LabelCache('Arial')
 
 
 class Viewport:
@@ -40,50 +56,74 @@ class Viewport:
         self.dims = (self.dims[0] * width_scale, self.dims[1] * height_scale)
 
 
-# Renders the given system onto img
+# How springs are drawn when this many are visible: 'lines' (one by one) or 'density' (a density raster)
+def spring_lod(visible_springs):
+    return 'density' if visible_springs > DENSITY_SPRING_COUNT else 'lines'
+
+
+# Renders the given system (or a SystemView of one) onto img, with bodies at positions (default the
+# system's positions). A system that is being stepped on another thread must be rendered from a view.
+# lod (see spring_lod) defaults to the one for the number of springs visible in the viewport, and
+# density_cell (see draw_density) to the one for the springs drawn.
 # viewport aspect ratio should match dims aspect ratio
-def render_system(system, viewport, img):
+def render_system(system, viewport, img, positions=None, lod=None, density_cell=None):
+    positions = system.positions if positions is None else positions
     dims = img.get_size()
     pixels_per_meter = dims[0] / viewport.dims[0]
 
-    def pos_to_render_pos(pos):
-        render_vect = (pos - viewport.topleft) * pixels_per_meter
-        return (round(render_vect.x), round(render_vect.y))
-    
-    def body_in_viewport(body):
-        x, y, r = *body.pos, body.radius
-        vx, vy, w, h = *viewport.topleft, *viewport.dims
-        return vx - r <= x <= vx + w + r and vy - r <= y <= vy + h + r      # TODO: bottom-edge clipping
-    
-    tl, w, h = viewport.topleft, *viewport.dims
-    viewport_points = [tl, tl + (w, 0), tl + (w, h), tl + (0, h)]
-    viewport_sides = [(viewport_points[i], viewport_points[i + 1]) for i in range(-1, 3)]
-    def spring_in_viewport(spring):
-        spring_segment = (spring.endpoints[0].pos, spring.endpoints[1].pos)
-        return any(body_in_viewport(b) for b in spring.endpoints) or \
-               any(line_segment_intersect(spring_segment, side) for side in viewport_sides)
+    lo = np.array(tuple(viewport.topleft))
+    hi = lo + viewport.dims
+    screen_positions = (positions - lo) * pixels_per_meter
+    render_positions = np.rint(screen_positions).astype(int)
+    radii = system.radii[:, None]
+    body_visible = ((positions >= lo - radii) & (positions <= hi + radii)).all(axis=1)
 
     # springs
-    for s in system.springs:
-        if not spring_in_viewport(s): continue
-        start = pos_to_render_pos(s.endpoints[0].pos)
-        end = pos_to_render_pos(s.endpoints[1].pos)
-        draw_width = max(2, round(s.k * pixels_per_meter / 60))
-        draw_aaline(img, start, end, BLACK, width=draw_width)
+    a, b = system.spring_endpoints.T
+    spring_visible = body_visible[a] | body_visible[b] | segments_intersect_rect(positions[a], positions[b], lo, hi)
+    with profiler.phase('draw springs'):
+        visible_springs = np.flatnonzero(spring_visible)
+        starts = screen_positions[a[visible_springs]]
+        ends = screen_positions[b[visible_springs]]
+        draw_widths = np.maximum(2, np.rint(system.spring_ks[visible_springs] * pixels_per_meter / 60))
+        if (lod or spring_lod(len(visible_springs))) == 'density':
+            draw_density(img, starts, ends, BLACK, density_cell, lo * pixels_per_meter)
+        else:
+            one_by_one = np.arange(len(visible_springs))
+            thin = draw_widths == 2
+            if thin.sum() >= THIN_SPRING_BATCH_COUNT:
+                draw_thin_lines(img, starts[thin], ends[thin], BLACK)
+                one_by_one = one_by_one[~thin]
+            for start, end, draw_width in zip(starts[one_by_one].tolist(), ends[one_by_one].tolist(), draw_widths[one_by_one].tolist()):
+                draw_aaline(img, start, end, BLACK, width=draw_width)
     
     # bodies
     label_padding = 8
-    lock_indicator_width = 3
-    for b in system.bodies:
-        if not body_in_viewport(b): continue
-        center = pos_to_render_pos(b.pos)
-        radius = round(b.radius * pixels_per_meter)
-        if b.locked: draw_aacircle(img, center, radius + lock_indicator_width, BLACK)
-        draw_aacircle(img, center, radius, b.color)
-        if b.label and radius >= label_padding * 2:
-            text = b.label if len(b.label) >= 5 else f' {b.label} '
-            label_font = get_sized_font('Arial', text, radius * 2 - label_padding * 2)
-            label_img = label_font.render(b.label, True, WHITE) # TODO: change color of text programatically
+    visible_bodies = np.flatnonzero(body_visible)
+    radii_px = system.radii[visible_bodies] * pixels_per_meter
+    with profiler.phase('draw bodies'):
+        points = visible_bodies[radii_px < POINT_RADIUS_PX]
+        if len(points):
+            draw_points(img, render_positions[points], system.colors[points])
+        for i in visible_bodies[radii_px >= POINT_RADIUS_PX]:
+            center = tuple(render_positions[i].tolist())
+            radius = round(system.radii[i] * pixels_per_meter)
+            draw_body = draw_aacircle if radius >= ANTIALIAS_RADIUS_PX else draw_circle
+            if system.locked[i]: draw_body(img, center, radius + LOCK_INDICATOR_WIDTH, BLACK)
+            draw_body(img, center, radius, to_color(system.colors[i]))
+
+    # labels (only on anti-aliased bodies, which are large enough to read them)
+    with profiler.phase('draw labels'):
+        labelled = visible_bodies[radii_px >= ANTIALIAS_RADIUS_PX]
+        labels = system.labels if len(labelled) else []
+        for i in labelled:
+            label = labels[i]
+            radius = round(system.radii[i] * pixels_per_meter)
+            if not label or radius < label_padding * 2:
+                continue
+            center = tuple(render_positions[i].tolist())
+            text = label if len(label) >= 5 else f' {label} '
+            label_img = label_cache.render(label, text, radius * 2 - label_padding * 2, WHITE) # TODO: change color of text programatically
             topleft = (
                 center[0] - label_img.get_width() // 2,
                 center[1] - label_img.get_height() // 2
@@ -94,6 +134,9 @@ def render_system(system, viewport, img):
 
 
 def run_system(system):
+    worker = PhysicsWorker(system)
+    worker.start()
+
     viewport = Viewport((0, 0), (8, 6))
     viewport_vel = V2(0, 0)
 
@@ -101,17 +144,29 @@ def run_system(system):
     screen = pygame.display.set_mode(screen_dims, pygame.RESIZABLE)
     screen.fill(WHITE)
 
-    def update_repulsion(new_value):
+    # these run on the physics thread
+    def set_repulsion(new_value):
         system.repulsion_coefficient = new_value
+        system.wake()
+
+    def set_friction(new_value):
+        system.friction_coefficient = new_value
+        system.wake()
+
+    def toggle_playing():
+        system.animation_playing = not system.animation_playing
+
+    def update_repulsion(new_value):
+        worker.submit(lambda: set_repulsion(new_value))
     
     def update_friction(new_value):
-        system.friction_coefficient = new_value
+        worker.submit(lambda: set_friction(new_value))
     
     def toggle_animation():
-        system.animation_playing = not system.animation_playing
+        worker.submit(toggle_playing)
     
     def rewind_animation():
-        system.animation_clock = 0
+        worker.submit(lambda: setattr(system, 'animation_clock', 0))
 
     # Initialize elements
     fps_indicator = Text((2, 2), '')
@@ -128,6 +183,16 @@ def run_system(system):
     ]
     element_selected = None
 
+    profile_overlay = TextBlock((2, 2), [])
+    frame_count = 0
+
+    # the rendered graph is kept and reused until the positions or the viewport change; otherwise
+    # only the UI elements that changed are redrawn (over the kept graph) and presented
+    scene = pygame.Surface(screen_dims)
+    scene_key = None
+    drawn_rects = {}    # element -> area it covered when last drawn
+    idle = False
+
     keys_pressed = set()
     body_selected = None
 
@@ -141,22 +206,37 @@ def run_system(system):
 
     def get_body_at_px(pos_px):
         pos = pixel_to_meter(pos_px)
-        bodies = system.get_bodies_at(pos)
+        bodies = worker.call(lambda: system.get_bodies_at(pos))
         return bodies[0] if bodies else None    # return the first one arbitrarily
 
     alive = True
     clock = pygame.time.Clock()
     while alive:
-        clock.tick(TARGET_FPS)
+        if idle:
+            events = [pygame.event.wait(IDLE_POLL_MS)] + pygame.event.get()    # blocks, so an idle window uses no CPU
+            clock.tick()
+        else:
+            clock.tick(TARGET_FPS)
+            events = pygame.event.get()
+        events = [event for event in events if event.type != pygame.NOEVENT]
+        redraw = False
 
         # handle user input events
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:   # quit gracefully
                 alive = False
                 continue
 
             elif event.type == pygame.KEYDOWN:
                 keys_pressed.add(event.key)
+                if event.key == pygame.K_p:     # toggle the profiler and its overlay
+                    profiler.enabled = not profiler.enabled
+                    profiler.reset()
+                    profile_overlay.set_lines(['profiling...'])
+                    redraw = True
+                elif event.key == pygame.K_t and profiler.events:     # save the recorded phases
+                    profiler.export_trace(PROFILE_TRACE_PATH)
+                    print(f'Saved profile trace to {PROFILE_TRACE_PATH}')
             elif event.type == pygame.KEYUP:
                 keys_pressed.remove(event.key)
 
@@ -169,7 +249,7 @@ def run_system(system):
 
                 elif event.button == 3:     # lock body
                     body = get_body_at_px(event.pos)
-                    if body: body.toggle_lock()
+                    if body: worker.submit(body.toggle_lock)
                 elif event.button == 4:     # zoom in
                     viewport.zoom(1 / VIEWPORT_ZOOM_FACTOR)
                 elif event.button == 5:     # zoom out
@@ -188,7 +268,9 @@ def run_system(system):
                 old_screen_dims = tuple(screen_dims)
                 screen_dims = (new_screen_width, new_screen_height)
                 screen = pygame.display.set_mode(screen_dims, pygame.RESIZABLE)
+                scene = pygame.Surface(screen_dims)
                 viewport.refit_to_screen(old_screen_dims, screen_dims)
+                redraw = True
 
         # handle viewport state changes
         if pygame.K_a in keys_pressed:
@@ -209,7 +291,7 @@ def run_system(system):
 
         # handle system state changes
         if pygame.K_SPACE in keys_pressed:
-            system.agitate()
+            worker.submit(system.agitate)
         
         # if pygame.K_UP in keys_pressed:
         #     system.repulsion_coefficient *= CONSTANT_SCALE_FACTOR
@@ -217,28 +299,54 @@ def run_system(system):
         #     system.repulsion_coefficient /= CONSTANT_SCALE_FACTOR
         
         if body_selected:
-            pos_px = pygame.mouse.get_pos()
-            body_selected.pos = V2(pixel_to_meter(pos_px))
-        
-        # handle UI element state changes
-        actual_fps = clock.get_fps()
-        fps_indicator.set_text(f'FPS: {actual_fps:.0f}')
+            pos = pixel_to_meter(pygame.mouse.get_pos())
+            worker.submit(lambda body=body_selected, pos=pos: setattr(body, 'pos', pos))
         
-        # render current frame
-        screen.fill(WHITE)
-        render_system(system, viewport, screen)
+        new_scene_key = (worker.current, tuple(viewport.topleft), tuple(viewport.dims))
+        redraw = redraw or new_scene_key != scene_key or not worker.settled
+
+        # handle UI element state changes (the frame rate only means something while the graph is redrawn)
+        if redraw:
+            fps_indicator.set_text(f'FPS: {clock.get_fps():.0f}')
+        frame_count += 1
+        if profiler.enabled and frame_count % PROFILE_OVERLAY_INTERVAL == 0:
+            profile_overlay.set_lines([f'{name:<15} {seconds * 1000:7.2f} ms' for name, seconds in profiler.averages().items()])
+            profile_overlay.move_to((screen_dims[0] - profile_overlay.rect.width - 2, 2))
+        visible_elements = elements + [profile_overlay] if profiler.enabled else elements
 
-        for elem in elements:
-            elem.render_onto(screen)
+        # render current frame
+        if redraw:
+            with profiler.phase('render'):
+                scene.fill(WHITE)
+                snapshot, positions = worker.interpolated_snapshot()
+                render_system(snapshot.system, viewport, scene, positions)
+            scene_key = new_scene_key
+            dirty_rects = [screen.get_rect()]
+        else:
+            dirty_rects = [e.bounds().union(drawn_rects.get(e, e.bounds())) for e in visible_elements if e.needs_redraw()]
+
+        with profiler.phase('ui'):
+            for rect in dirty_rects:
+                screen.set_clip(rect)
+                screen.blit(scene, rect, rect)
+                for elem in visible_elements:
+                    if elem.bounds().colliderect(rect):
+                        elem.render_onto(screen)
+                        drawn_rects[elem] = elem.bounds()
+            screen.set_clip(None)
         
         # test_rect = pygame.Rect(500, 500, 150, 100)
         # draw_aarectangle(screen, test_rect, BLACK, 10)
         # pygame.draw.rect(screen, (255, 0, 0), test_rect, 1)
 
-        pygame.display.update()
+        if dirty_rects:
+            with profiler.phase('display update'):
+                pygame.display.update(dirty_rects)
+
+        # nothing will change until input arrives or the system wakes up
+        idle = not dirty_rects and not events and not keys_pressed and body_selected is None and worker.idle and not profiler.enabled
 
-        # step system
-        system.step(TIMESTEP_PER_FRAME)
+    worker.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,37 @@
+import sys
+
+import numpy as np
+
+from Physics import System, exact_repulsion
+from BarnesHut import barnes_hut_repulsion
+
+
+# Compares Barnes-Hut repulsion against the exact pairwise loop on small random graphs
+MAX_RELATIVE_ERROR = {0.25: 0.01, 0.5: 0.03, 1.0: 0.1}
+
+
+def relative_error(approx, exact):
+    return np.linalg.norm(approx - exact) / np.linalg.norm(exact)
+
+
+failures = 0
+for num_bodies in [2, 10, 50, 200, 1000]:
+    system = System.random(num_bodies, num_bodies)
+    for _ in range(20):
+        system.step(0.05)
+    exact = exact_repulsion(system.positions, system.charges)
+
+    # theta = 0 never approximates, so it must reproduce the exact loop
+    zero_theta_error = relative_error(barnes_hut_repulsion(system.positions, system.charges, 0), exact)
+    print(f'n={num_bodies:5d}  theta=0.00  error={zero_theta_error:.2e}')
+    if zero_theta_error > 1e-9:
+        failures += 1
+
+    for theta, max_error in MAX_RELATIVE_ERROR.items():
+        error = relative_error(barnes_hut_repulsion(system.positions, system.charges, theta), exact)
+        print(f'n={num_bodies:5d}  theta={theta:.2f}  error={error:.2e}{"  FAIL" if error > max_error else ""}')
+        if error > max_error:
+            failures += 1
+
+print('all checks passed' if failures == 0 else f'{failures} checks failed')
+sys.exit(1 if failures else 0)
@@ -0,0 +1,127 @@
+import threading
+import time
+from queue import Queue, Empty
+
+from Physics import SystemView
+
+
+PHYSICS_TIMESTEP = 0.05             # simulated seconds per step
+PHYSICS_STEPS_PER_SECOND = None     # None steps as fast as the hardware allows
+ANIMATION_SPEED = 3.0               # animation seconds per wall-clock second
+
+
+# Everything the renderer reads of the system, published by the physics thread after a step (or after
+# commands changed it); never modified once published
+class Snapshot:
+    def __init__(self, system, time):
+        self.system = SystemView(system)
+        self.positions = self.system.positions
+        self.structure_version = system.structure_version
+        self.time = time
+
+
+# Steps a System on its own thread. Everything that changes the system (dragging, locking,
+# agitating, editing parameters) must be submitted to run on that thread between steps; the
+# renderer draws from the published snapshots instead of the live arrays.
+class PhysicsWorker:
+    def __init__(self, system, timestep=PHYSICS_TIMESTEP, steps_per_second=PHYSICS_STEPS_PER_SECOND):
+        self.system = system
+        self.timestep = timestep
+        self.steps_per_second = steps_per_second
+        self.commands = Queue()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.steps_taken = 0
+
+        snapshot = Snapshot(system, time.perf_counter())
+        self.snapshots = (snapshot, snapshot)   # previous and current, replaced together
+
+    @property
+    def current(self):
+        return self.snapshots[1]
+
+    def publish(self):
+        self.snapshots = (self.snapshots[1], Snapshot(self.system, time.perf_counter()))
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.commands.put(None)     # wake the thread if it is idle
+        self.thread.join()
+
+    # Runs fn on the physics thread before the next step
+    def submit(self, fn):
+        self.commands.put(fn)
+
+    # Runs fn on the physics thread and waits for its result
+    def call(self, fn):
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = fn()
+            except Exception as e:
+                outcome['error'] = e
+            done.set()
+
+        self.submit(run)
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    # Returns whether any command ran
+    def process_commands(self, block):
+        ran = False
+        while True:
+            try:
+                command = self.commands.get(block=block)
+            except Empty:
+                return ran
+            if command is not None:
+                command()
+                ran = True
+            block = False
+
+    @property
+    def idle(self):
+        return self.system.asleep and not self.system.animation_playing
+
+    def run(self):
+        last_step_time = time.perf_counter()
+        while self.running:
+            if self.idle:
+                if self.process_commands(block=True):   # sleep until something changes
+                    self.publish()
+                last_step_time = time.perf_counter()
+                continue
+            self.process_commands(block=False)
+
+            now = time.perf_counter()
+            self.system.step(self.timestep, animation_timestep=(now - last_step_time) * ANIMATION_SPEED)
+            last_step_time = now
+            self.steps_taken += 1
+            self.publish()
+
+            if self.steps_per_second:
+                time.sleep(max(0.0, 1 / self.steps_per_second - (time.perf_counter() - now)))
+
+    # True once interpolated_snapshot has caught up with the latest snapshot (and stopped changing)
+    @property
+    def settled(self):
+        previous, current = self.snapshots
+        return time.perf_counter() - current.time >= current.time - previous.time
+
+    # The latest snapshot, and its positions interpolated from the one before, lagging one step behind
+    # the simulation (not across added or removed bodies)
+    def interpolated_snapshot(self):
+        previous, current = self.snapshots
+        interval = current.time - previous.time
+        if interval <= 0 or previous.structure_version != current.structure_version:
+            return current, current.positions
+        alpha = min(1.0, (time.perf_counter() - current.time) / interval)
+        return current, previous.positions + (current.positions - previous.positions) * alpha
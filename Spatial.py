@@ -0,0 +1,110 @@
+import numpy as np
+
+
+GRID_CELL_SIZE = 1.0        # meters
+KEY_OFFSET = 1 << 31        # keeps cell coordinates non-negative inside a key
+
+
+def cell_keys(cells):
+    return ((cells[:, 0] + KEY_OFFSET) << 32) | (cells[:, 1] + KEY_OFFSET)
+
+
+# Uniform grid over body positions. Bodies are kept sorted by cell key, so the bodies in one
+# column of cells form a contiguous run that can be found with a binary search.
+# Bodies can be added, removed and re-bucketed cheaply: the ones that changed cell are flagged in a
+# mask and merged back into the sorted order at the next query, without re-sorting the rest.
+class SpatialGrid:
+    def __init__(self, positions, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cell_buffer = self.cells = self.cells_of(positions)
+        self.rebuild()
+
+    def cells_of(self, positions):
+        return np.floor(positions / self.cell_size).astype(np.int64).reshape(-1, 2)
+
+    def rebuild(self):
+        keys = cell_keys(self.cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        self.pending = np.zeros(len(self.cell_buffer), dtype=bool)      # slots that changed cell since the last merge
+        self.dirty = False
+        self.min_cell = self.cells.min(axis=0, initial=0)
+        self.max_cell = self.cells.max(axis=0, initial=0)
+
+    # Takes the changed bodies out of the sorted order and inserts them again at their new keys
+    def merge(self):
+        n = len(self.cells)
+        changed = np.flatnonzero(self.pending)
+        self.pending[n:] = True     # removed
+        keep = ~self.pending[self.order]
+        order, keys = self.order[keep], self.sorted_keys[keep]
+
+        changed = changed[changed < n]
+        changed_keys = cell_keys(self.cells[changed])
+        by_key = np.argsort(changed_keys, kind='stable')
+        changed, changed_keys = changed[by_key], changed_keys[by_key]
+        at = np.searchsorted(keys, changed_keys, side='right')
+        self.order = np.insert(order, at, changed)
+        self.sorted_keys = np.insert(keys, at, changed_keys)
+        self.pending[:] = False
+        self.dirty = False
+        # the bounds only clip queries, so they are grown here and only tightened by a rebuild
+        if len(changed):
+            self.min_cell = np.minimum(self.min_cell, self.cells[changed].min(axis=0))
+            self.max_cell = np.maximum(self.max_cell, self.cells[changed].max(axis=0))
+
+    def append(self, position):
+        n = len(self.cells)
+        if n == len(self.cell_buffer):
+            grown = np.zeros((max(1, 2 * n), 2), dtype=np.int64)
+            grown[:n] = self.cells
+            self.cell_buffer = grown
+            self.pending = np.concatenate([self.pending, np.zeros(len(grown) - len(self.pending), dtype=bool)])
+        self.cell_buffer[n] = self.cells_of(np.asarray(position))[0]
+        self.cells = self.cell_buffer[:n + 1]
+        self.pending[n] = True
+        self.dirty = True
+
+    # Removes body index, moving the last body into its place
+    def swap_remove(self, index):
+        last = len(self.cells) - 1
+        self.cells[index] = self.cells[last]
+        self.cells = self.cell_buffer[:last]
+        self.pending[[index, last]] = True
+        self.dirty = True
+
+    # Re-buckets the given bodies (default all); only the ones that changed cell are re-inserted
+    def update(self, positions, indices=None):
+        if indices is None:
+            cells = self.cells_of(positions)
+            if len(cells) != len(self.cells):
+                self.cell_buffer = self.cells = cells
+                self.rebuild()
+                return
+            indices = np.arange(len(cells))
+        else:
+            indices = np.asarray(indices, dtype=np.intp)
+            cells = self.cells_of(positions[indices])
+        moved = (cells != self.cells[indices]).any(axis=1)
+        if moved.any():
+            self.cells[indices[moved]] = cells[moved]
+            self.pending[indices[moved]] = True
+            self.dirty = True
+
+    # Indices of the bodies in every cell overlapping the rectangle [lo, hi]
+    def query_rect(self, lo, hi):
+        if self.dirty:
+            self.merge()
+        cell_lo = np.maximum(np.floor(np.asarray(lo) / self.cell_size).astype(np.int64), self.min_cell)
+        cell_hi = np.minimum(np.floor(np.asarray(hi) / self.cell_size).astype(np.int64), self.max_cell)
+        if (cell_lo > cell_hi).any():
+            return np.empty(0, dtype=np.intp)
+
+        columns = np.arange(cell_lo[0], cell_hi[0] + 1)
+        first_keys = cell_keys(np.column_stack([columns, np.full_like(columns, cell_lo[1])]))
+        last_keys = cell_keys(np.column_stack([columns, np.full_like(columns, cell_hi[1])]))
+        starts = np.searchsorted(self.sorted_keys, first_keys, side='left')
+        ends = np.searchsorted(self.sorted_keys, last_keys, side='right')
+        lengths = ends - starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.order[np.repeat(starts, lengths) + offsets]
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+# Sparse stress majorization (Ortmann, Klimenta & Brandes): instead of the n^2 terms of full stress,
+# every vertex is kept at its edge lengths from its neighbours and at its graph-theoretic distance
+# from a small set of pivots. A pivot stands in for the vertices of its region (the vertices closer
+# to it than to any other pivot), so its term is weighted by how many of them lie between it and
+# the vertex. Memory and time per iteration are O(pivots * n + edges).
+
+STRESS_PIVOTS = 50
+STRESS_ITERATIONS = 300
+STRESS_TOLERANCE = 1e-4     # stop once an iteration lowers the stress by less than this fraction
+
+
+# Picks pivots by max-min sampling: each new pivot is the vertex furthest from all earlier ones
+# (vertices no pivot reaches come first, so every component gets one while pivots last).
+# Returns the pivot ids and their BFS distances, (pivots, n) with -1 where unreachable.
+def select_pivots(graph, count=STRESS_PIVOTS):
+    n = len(graph.vertices)
+    count = min(count, n)
+    pivots = np.empty(count, dtype=np.intp)
+    distances = np.empty((count, n), dtype=np.int32)
+    nearest = np.full(n, np.inf)
+    pivot = np.random.randint(n) if n else 0
+    for k in range(count):
+        pivots[k] = pivot
+        distances[k] = graph.bfs_distances(pivot)
+        nearest = np.minimum(nearest, np.where(distances[k] >= 0, distances[k], np.inf))
+        pivot = int(np.argmax(nearest))
+    return pivots, distances
+
+
+# (i, j, target distance, weight) of every stress term moving vertex i; edge lengths are aligned with
+# graph.sources, and pivot distances are in units of the mean edge length
+def stress_terms(graph, edge_lengths, pivots, distances):
+    loops = graph.sources == graph.targets
+    a, b, lengths = graph.sources[~loops], graph.targets[~loops], edge_lengths[~loops]
+    terms_i, terms_j, terms_d, terms_w = [np.r_[a, b]], [np.r_[b, a]], [np.r_[lengths, lengths]], [np.r_[lengths, lengths] ** -2.0]
+
+    unit = lengths.mean() if len(lengths) else 1.0
+    reachable = np.where(distances >= 0, distances, np.iinfo(np.int32).max)
+    region = np.argmin(reachable, axis=0)
+    for k, pivot in enumerate(pivots):
+        members = np.sort(distances[k][region == k])
+        vertices = np.flatnonzero(distances[k] > 0)
+        d = distances[k][vertices]
+        # vertices of the pivot's region at most half way from the pivot to the vertex
+        represented = np.maximum(np.searchsorted(members, d / 2, side='right'), 1)
+        terms_i.append(vertices)
+        terms_j.append(np.full(len(vertices), pivot))
+        terms_d.append(d * unit)
+        terms_w.append(represented / (d * unit) ** 2)
+    return tuple(np.concatenate(terms) for terms in [terms_i, terms_j, terms_d, terms_w])
+
+
+def stress(positions, terms):
+    i, j, d, w = terms
+    dist = np.hypot(*(positions[i] - positions[j]).T)
+    return float((w * (dist - d) ** 2).sum())
+
+
+# Localized majorization: every vertex moves to the weighted average of the positions its terms
+# ask for, all vertices at once. Positions are kept as complex numbers, which are much faster to
+# gather than rows. Returns the number of iterations taken.
+def majorize(positions, terms, iterations=STRESS_ITERATIONS, tolerance=STRESS_TOLERANCE):
+    i, j, d, w = terms
+    n = len(positions)
+    total_weight = np.bincount(i, w, n)
+    moving = total_weight > 0
+    z = positions[:, 0] + 1j * positions[:, 1]
+    previous = np.inf
+    for iteration in range(iterations):
+        zj = z[j]
+        disp = z[i] - zj
+        dist = np.abs(disp)
+        current = (w * (dist - d) ** 2).sum()      # stress before this iteration's move
+        if previous - current < tolerance * previous:
+            break
+        previous = current
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(dist > 0, d / dist, 0)
+        wanted = (zj + disp * scale) * w
+        z[moving] = (np.bincount(i, wanted.real, n) + 1j * np.bincount(i, wanted.imag, n))[moving] / total_weight[moving]
+    else:
+        iteration = iterations
+    positions[:, 0], positions[:, 1] = z.real, z.imag
+    return iteration
+
+
+# Positions (aligned with graph.vertices) at the sparse stress minimum reached from positions (default
+# random). Separate components are laid out independently and may overlap.
+def stress_layout(graph, spring_length_function=lambda w: 1, positions=None, pivots=STRESS_PIVOTS,
+                  iterations=STRESS_ITERATIONS, tolerance=STRESS_TOLERANCE):
+    n = len(graph.vertices)
+    edge_lengths = np.array([spring_length_function(w) for w in graph.weights.tolist()], dtype=float)
+    if positions is None:
+        side = np.sqrt(max(n, 1)) * (edge_lengths.mean() if len(edge_lengths) else 1.0)
+        positions = np.random.uniform(0, side, (n, 2))
+    positions = np.array(positions, dtype=float).reshape(n, 2)
+    if n < 2:
+        return positions
+    pivot_ids, distances = select_pivots(graph, pivots)
+    majorize(positions, stress_terms(graph, edge_lengths, pivot_ids, distances), iterations, tolerance)
+    return positions
+
+
+# Lays out a System built from graph by System.from_graph, starting from its bodies' current positions
+# and writing the result back into them; the bodies are left at rest and awake so that the simulation
+# (e.g. run_system) can refine the layout
+def apply_stress_layout(system, graph, spring_length_function=lambda w: 1, **options):
+    if len(system.bodies) != len(graph.vertices):
+        raise Exception('System does not match graph')
+    system.positions[:] = stress_layout(graph, spring_length_function, system.positions, **options)
+    system.velocities[:] = 0
+    system.grid.update(system.positions)
+    system.wake()
@@ -5,12 +5,22 @@ from Images import *
 from UIHelpers import *
 
 
+# Elements keep their appearance in cached surfaces, which are only rebuilt when their state changes.
+# dirty is set by those changes and cleared by render_onto, so unchanged elements need not be redrawn.
 class UIElement:
     children = []
+    dirty = True
 
     def render_onto(self, surf):
         raise NotImplementedError
 
+    def needs_redraw(self):
+        return self.dirty or any(child.needs_redraw() for child in self.children)
+
+    # Area covered by the element and its children
+    def bounds(self):
+        return bounding_box([self.rect] + [child.bounds() for child in self.children])
+
     def intersects_point(self, pos):
         return self.rect.collidepoint(pos)
     
@@ -36,15 +46,59 @@ class Text(UIElement):
         self.pos = pos
         self.font = font
         self.color = color
+        self.text = None
         self.set_text(text)
     
     def render_onto(self, surf):
         surf.blit(self.img, self.pos)
+        self.dirty = False
     
     def set_text(self, text):
+        if text == self.text:
+            return
         self.text = text
         self.img = self.font.render(text, True, self.color)
         self.rect = pygame.Rect(self.pos, self.img.get_size())
+        self.dirty = True
+
+
+# Several lines of text on a translucent background
+class TextBlock(UIElement):
+    default_font = pygame.font.SysFont('Courier', 16, bold=False)
+    background_color = (255, 255, 255, 200)
+    padding = 6
+
+    def __init__(self, pos, lines, font=default_font, color=BLACK):
+        self.pos = pos
+        self.font = font
+        self.color = color
+        self.lines = None
+        self.set_lines(lines)
+
+    def render_onto(self, surf):
+        surf.blit(self.img, self.pos)
+        self.dirty = False
+
+    def set_lines(self, lines):
+        if lines == self.lines:
+            return
+        self.lines = lines
+        line_imgs = [self.font.render(line, True, self.color) for line in lines]
+        width = max((img.get_width() for img in line_imgs), default=0) + self.padding * 2
+        height = sum(img.get_height() for img in line_imgs) + self.padding * 2
+        self.img = pygame.Surface((width, height), pygame.SRCALPHA)
+        self.img.fill(self.background_color)
+        y = self.padding
+        for img in line_imgs:
+            self.img.blit(img, (self.padding, y))
+            y += img.get_height()
+        self.rect = pygame.Rect(self.pos, self.img.get_size())
+        self.dirty = True
+
+    def move_to(self, pos):
+        if tuple(pos) != tuple(self.pos):
+            self.pos = self.rect.topleft = pos
+            self.dirty = True
 
 
 class Button(UIElement):
@@ -70,11 +124,27 @@ class Button(UIElement):
 
         self.on_press = on_press
         self.pressed = False
+        self.pressed_imgs = {}      # img -> img with the opacity filter applied
+
+    @property
+    def pressed(self):
+        return self._pressed
+
+    @pressed.setter
+    def pressed(self, value):
+        self._pressed = value
+        self.dirty = True
+
+    def pressed_img(self):
+        if self.img not in self.pressed_imgs:
+            img = self.img.copy()
+            img.blit(self.opacity_filter, (0, 0))
+            self.pressed_imgs[self.img] = img
+        return self.pressed_imgs[self.img]
 
     def render_onto(self, surf):
-        surf.blit(self.img, self.pos)
-        if self.pressed and self.opacity:
-            surf.blit(self.opacity_filter, self.pos)
+        surf.blit(self.pressed_img() if self.pressed and self.opacity else self.img, self.pos)
+        self.dirty = False
 
     def handle_mouse_down(self, pos):
         self.pressed = True
@@ -110,6 +180,7 @@ class ToggleButton(Button):
 
         self.on_press = on_press
         self.pressed = False
+        self.pressed_imgs = {}
     
     def handle_mouse_up(self, pos):
         self.img = self.img_off if self.img is self.img_on else self.img_on
@@ -147,3 +218,4 @@ class ValueEditor(UIElement):
     def render_onto(self, surf):
         for child in self.children:
             child.render_onto(surf)
+        self.dirty = False
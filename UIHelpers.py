@@ -1,10 +1,23 @@
+import numpy as np
 from pygame.math import Vector2 as V2
 import pygame.gfxdraw
 import pygame.draw
+import pygame.surfarray
+from collections import OrderedDict
 from functools import lru_cache
 from math import floor, ceil
 
 
+MIN_FONT_SIZE = 8
+MAX_FONT_SIZE = 100
+REFERENCE_FONT_SIZE = 100           # size at which text is measured before scaling to fit
+LABEL_SIZE_STEP = 4                 # label widths are rounded down to a multiple of this (px)
+LABEL_CACHE_BUDGET = 32 * 2 ** 20   # bytes of rendered label surfaces kept
+DENSITY_GAIN = 0.3                  # opacity added by each line crossing a pixel of a density raster
+DENSITY_SAMPLES_PER_PIXEL = 2       # density rasters sample at most about this many points per pixel
+SAMPLE_CHUNK_SIZE = 1 << 20         # points sampled along segments at once
+
+
 def draw_aaline(surf, start, end, color, width):
     if width == 1:
         pygame.draw.line(surf, color, start, end, width)
@@ -49,27 +62,209 @@ def draw_aacircle(surf, center, radius, color):
     pygame.gfxdraw.aacircle(surf, *center, radius, color)
 
 
+def draw_circle(surf, center, radius, color):
+    pygame.draw.circle(surf, color, center, radius)
+
+
+# Sets one pixel per point (an (n, 2) integer array) to the matching row of colors
+def draw_points(surf, points, colors):
+    w, h = surf.get_size()
+    inside = (points[:, 0] >= 0) & (points[:, 0] < w) & (points[:, 1] >= 0) & (points[:, 1] < h)
+    pixels = pygame.surfarray.pixels3d(surf)
+    pixels[points[inside, 0], points[inside, 1]] = np.asarray(colors)[inside]
+    del pixels      # unlock the surface
+
+
+# Clips each segment to the rectangle [lo, hi] (Liang-Barsky); returns the clipped endpoints
+# and a mask of the segments that overlap the rectangle at all
+def clip_segments(starts, ends, lo, hi):
+    d = ends - starts
+    t0 = np.zeros(len(starts))
+    t1 = np.ones(len(starts))
+    keep = np.ones(len(starts), dtype=bool)
+    for axis in range(2):
+        for p, q in ((-d[:, axis], starts[:, axis] - lo[axis]), (d[:, axis], hi[axis] - starts[:, axis])):
+            parallel = p == 0
+            keep &= ~(parallel & (q < 0))
+            r = np.divide(q, p, out=np.zeros_like(q), where=~parallel)
+            t0 = np.where(p < 0, np.maximum(t0, r), t0)
+            t1 = np.where(p > 0, np.minimum(t1, r), t1)
+    keep &= t0 <= t1
+    return starts + d * t0[:, None], starts + d * t1[:, None], keep
+
+
+# Number of points sample_segments gives for segments of the given lengths
+def sample_counts(lengths, spacing=1, skip=0):
+    return np.maximum(np.floor((lengths - skip) / spacing).astype(np.intp) + 1, 0)
+
+
+# Points spacing pixels apart along each segment, starting skip (per segment) pixels from its start
+def sample_segments(starts, ends, spacing=1, skip=0):
+    d = ends - starts
+    lengths = np.hypot(d[:, 0], d[:, 1])
+    skip = np.broadcast_to(skip, lengths.shape)
+    counts = sample_counts(lengths, spacing, skip)
+    segment = np.repeat(np.arange(len(starts)), counts)
+    steps = np.arange(len(segment)) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = (skip[segment] + steps * spacing) / np.maximum(lengths, np.finfo(float).tiny)[segment]
+    return starts[segment] + d[segment] * t[:, None]
+
+
+# Ranges of consecutive segments with about size samples (given per segment) in each
+def sample_chunks(counts, size=SAMPLE_CHUNK_SIZE):
+    sample_ends = np.cumsum(counts)
+    chunk_ends = np.searchsorted(sample_ends, np.arange(size, sample_ends[-1] if len(sample_ends) else 0, size)).tolist()
+    return zip([0, *chunk_ends], [*chunk_ends, len(counts)])
+
+
+# Sets the pixels of surf at the given row-major indices (y * width + x) to color
+def fill_pixels(surf, covered, color):
+    w = surf.get_width()
+    if surf.get_bytesize() != 4 or surf.get_pitch() != w * 4:
+        y, x = np.divmod(covered, w)
+        pixels = pygame.surfarray.pixels3d(surf)
+        pixels[x, y] = color[:3]
+        del pixels      # unlock the surface
+        return
+
+    pixels = pygame.surfarray.pixels2d(surf).T.reshape(-1)
+    pixels[covered] = surf.map_rgb(color)
+    del pixels
+
+
+# Blends color into the pixels of surf at the given row-major indices (y * width + x) by the given opacity
+def blend_pixels(surf, covered, opacity, color):
+    w = surf.get_width()
+    if surf.get_bytesize() != 4 or surf.get_pitch() != w * 4:
+        y, x = np.divmod(covered, w)
+        pixels = pygame.surfarray.pixels3d(surf)
+        pixels[x, y] = pixels[x, y] * (1 - opacity[:, None]) + np.asarray(color) * opacity[:, None]
+        del pixels      # unlock the surface
+        return
+
+    # 32-bit surfaces without row padding can be indexed through one flat view, which is much faster
+    pixels = pygame.surfarray.pixels2d(surf).T.reshape(-1)
+    values = pixels[covered]
+    masks, shifts = surf.get_masks(), surf.get_shifts()
+    blended = values & np.uint32(~(masks[0] | masks[1] | masks[2]) & 0xFFFFFFFF)
+    for mask, shift, c in zip(masks, shifts, color[:3]):
+        channel = ((values & np.uint32(mask)) >> np.uint32(shift)).astype(np.int64)
+        blended |= (channel + (c - channel) * opacity).astype(np.uint32) << np.uint32(shift)
+    pixels[covered] = blended
+    del pixels
+
+
+# Draws 2 px wide lines without anti-aliasing all at once, instead of one by one like draw_aaline:
+# each segment is sampled every pixel (from its unclipped start, so adjacent surfaces agree) and the
+# pixel nearest every sample is set along with its four neighbours, which covers about as much as
+# draw_aaline's anti-aliased edges do
+def draw_thin_lines(surf, starts, ends, color):
+    w, h = surf.get_size()
+    if w < 3 or h < 3:
+        return
+    clipped_starts, clipped_ends, keep = clip_segments(starts, ends, (0, 0), (w - 1, h - 1))
+    skips = -np.hypot(*(clipped_starts[keep] - starts[keep]).T) % 1
+    starts, ends = clipped_starts[keep], clipped_ends[keep]
+    lengths = np.hypot(*(ends - starts).T)
+    for a, b in sample_chunks(sample_counts(lengths, 1, skips)):
+        centers = np.rint(sample_segments(starts[a:b], ends[a:b], 1, skips[a:b])).astype(np.intp)
+        np.clip(centers, 1, (w - 2, h - 2), out=centers)
+        covered = centers[:, 1] * w + centers[:, 0]
+        fill_pixels(surf, (covered[:, None] + [0, -1, 1, -w, w]).reshape(-1), color)
+
+
+# Side (px) of the cells a density raster of the segments counts on: 1 unless their total length on a
+# surface of the given dims is more than DENSITY_SAMPLES_PER_PIXEL samples per pixel
+def density_cell_size(starts, ends, dims):
+    w, h = dims
+    starts, ends, keep = clip_segments(starts, ends, (0, 0), (w - 1, h - 1))
+    lengths = np.hypot(*(ends[keep] - starts[keep]).T)
+    return max(1, int(np.ceil(lengths.sum() / (DENSITY_SAMPLES_PER_PIXEL * w * h))))
+
+
+# Accumulates how many segments cross each pixel and darkens the surface towards color accordingly,
+# instead of drawing the segments one by one. The segments are sampled a chunk at a time, and once
+# their total length outgrows the surface they are counted on a coarser grid of cells (of side cell,
+# default density_cell_size) that is scaled back up, so that time and memory are bounded by the
+# surface area rather than the number of segments. Cells are aligned to multiples of cell from
+# origin (the surface's offset in pixels), so that adjacent surfaces like poster tiles line up.
+def draw_density(surf, starts, ends, color, cell=None, origin=(0, 0)):
+    w, h = surf.get_size()
+    cell = cell or density_cell_size(starts, ends, (w, h))
+    clipped_starts, clipped_ends, keep = clip_segments(starts, ends, (0, 0), (w - 1, h - 1))
+    # samples fall on multiples of cell from each segment's unclipped start, so adjacent surfaces agree
+    skips = -np.hypot(*(clipped_starts[keep] - starts[keep]).T) % cell
+    starts, ends = clipped_starts[keep], clipped_ends[keep]
+    lengths = np.hypot(*(ends - starts).T)
+    origin = np.rint(origin).astype(np.intp)
+    column_of = (np.arange(w) + origin[0]) // cell - origin[0] // cell
+    row_of = (np.arange(h) + origin[1]) // cell - origin[1] // cell
+    columns, rows = column_of[-1] + 1, row_of[-1] + 1
+
+    # samples are cell pixels apart, so each one stands for a line crossing cell of the cell's pixels
+    counts = np.zeros(columns * rows)
+    for a, b in sample_chunks(sample_counts(lengths, cell, skips)):
+        points = sample_segments(starts[a:b], ends[a:b], cell, skips[a:b])
+        pixels = np.rint(points).astype(np.intp)
+        counts += np.bincount(row_of[pixels[:, 1]] * columns + column_of[pixels[:, 0]], minlength=len(counts))
+    counts = (counts / cell).reshape(rows, columns)
+    if cell > 1:
+        counts = counts[row_of[:, None], column_of[None, :]]
+
+    covered = np.flatnonzero(counts)
+    blend_pixels(surf, covered, 1 - np.exp(-DENSITY_GAIN * counts.reshape(-1)[covered]), color)
+
+
 pygame.font.init()
-# Binary search to find a font size s.t. the given text fills width_px pixels horizontally
-@lru_cache(maxsize=1000)
+# One font object per family, size and weight
+@lru_cache(maxsize=None)
+def get_font(font_family, size, bold=False):
+    return pygame.font.SysFont(font_family, size, bold=bold)
+
+
+@lru_cache(maxsize=10000)
+def measure_text(font_family, text, bold=False):
+    return max(get_font(font_family, REFERENCE_FONT_SIZE, bold).size(text))
+
+
+# Largest font size (within bounds) s.t. the given text fits in width_px pixels. Text size is close to
+# proportional to font size, so the reference measurement gives the answer up to rounding.
+@lru_cache(maxsize=10000)
 def get_sized_font(font_family, text, width_px, bold=False):
-    size_lower_bound = 8
-    size_upper_bound = 100
+    reference_px = max(measure_text(font_family, text, bold), 1)
+    size = width_px * REFERENCE_FONT_SIZE // reference_px
+    size = min(max(size, MIN_FONT_SIZE), MAX_FONT_SIZE)
+    while size > MIN_FONT_SIZE and max(get_font(font_family, size, bold).size(text)) >= width_px:
+        size -= 1
+    return get_font(font_family, size, bold)
 
-    font = None
-    size = width_px  # initial guess
-    while size_upper_bound - size_lower_bound > 1:
-        font = pygame.font.SysFont(font_family, size, bold=bold)
-        text_size_px = max(font.size(text))
-        error = text_size_px - width_px
-        # print(size, error, size_lower_bound, size_upper_bound)
-        if error >= 0:
-            size_upper_bound = size
-        else:
-            size_lower_bound = size
-        size = (size_lower_bound + size_upper_bound) // 2
 
-    return font
+# Rendered text surfaces keyed by text, color and quantized width, evicted least recently used
+# first once they take up more than budget bytes
+class LabelCache:
+    def __init__(self, font_family, budget=LABEL_CACHE_BUDGET):
+        self.font_family = font_family
+        self.budget = budget
+        self.size = 0
+        self.surfaces = OrderedDict()
+
+    # sizing_text is fitted to width_px; text is what gets drawn
+    def render(self, text, sizing_text, width_px, color):
+        width_px -= width_px % LABEL_SIZE_STEP
+        key = (text, sizing_text, width_px, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        font = get_sized_font(self.font_family, sizing_text, width_px)
+        surface = font.render(text, True, color)
+        self.surfaces[key] = surface
+        self.size += surface.get_bytesize() * surface.get_width() * surface.get_height()
+        while self.size > self.budget and len(self.surfaces) > 1:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.size -= evicted.get_bytesize() * evicted.get_width() * evicted.get_height()
+        return surface
 
 
 def bounding_box(rect_list):
@@ -83,3 +278,13 @@ def ccw(A, B, C):
 def line_segment_intersect(line_a, line_b):
     A, B, C, D = *line_a, *line_b
     return ccw(A,C,D) != ccw(B,C,D) and ccw(A,B,C) != ccw(A,B,D)
+
+
+# Vectorized test of which segments (starts[i], ends[i]) touch the axis-aligned rectangle [lo, hi]:
+# their bounding boxes must overlap and the rectangle's corners must not all lie on one side of the line
+def segments_intersect_rect(starts, ends, lo, hi):
+    overlap = ((np.minimum(starts, ends) <= hi) & (np.maximum(starts, ends) >= lo)).all(axis=1)
+    d = ends - starts
+    corners = [(lo[0], lo[1]), (hi[0], lo[1]), (hi[0], hi[1]), (lo[0], hi[1])]
+    sides = np.stack([d[:, 0] * (y - starts[:, 1]) - d[:, 1] * (x - starts[:, 0]) for x, y in corners])
+    return overlap & (sides.min(axis=0) <= 0) & (sides.max(axis=0) >= 0)